@@ -5,31 +5,58 @@ and filters for the list view.
 """
 
 import re
+import time
+import logging
 import isbnlib
 
+from collections import defaultdict
+from contextlib import ExitStack
 from datetime import datetime
 
+from django.conf import settings
+from django.contrib import messages
 from django.contrib.admin import ModelAdmin, register, helpers, SimpleListFilter
-from django.db.models import Count
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
 from django.db.models.query import Prefetch
 from django.utils.translation import ugettext_lazy as _
 from django.utils.text import Truncator
-from django.http import HttpResponse
+from django.utils.html import format_html
+from django.utils import timezone
+from django.http import StreamingHttpResponse
 from django.template.response import TemplateResponse
 from django.core.mail.message import EmailMessage
+from django.test.utils import CaptureQueriesContext
 
 from import_export.resources import ModelResource
+from import_export.instance_loaders import CachedInstanceLoader
 from import_export.admin import ImportExportMixin
 from import_export.widgets import ManyToManyWidget, ForeignKeyWidget, Widget
 from import_export.fields import Field
 
-from .models import Book, Order, Student, OrderTimeframe, Module, Literature, Semester, ModuleCategory, DisplayMessage
+from .models import Book, Order, Student, OrderTimeframe, Module, Literature, Semester, ModuleCategory, DisplayMessage, OutboxMessage, refresh_counters
 from .mixins import ForeignKeyImportResourceMixin
-from .data import net_library_csv
-from .mail import OrderAcceptedMessage, OrderArrivedMessage, OrderRejectedMessage, CustomMessage
+from .data import net_library_csv_chunks
+from .mail import OrderAcceptedMessage, OrderArrivedMessage, OrderRejectedMessage, queue_order_messages, CustomMessage, MessageFragments
 from .forms import OrderTimeframeForm
 
 
+logger = logging.getLogger(__name__)
+
+
+def warn_failed_messages(model_admin, request):
+    """
+    Warns the user about messages in the outbox that could not be
+    delivered, with a link to them.
+    """
+    failed = OutboxMessage.objects.filter(state=OutboxMessage.FAILED).count()
+    if failed:
+        url = reverse('admin:pyBuchaktion_outboxmessage_changelist') + '?state__exact=' + OutboxMessage.FAILED
+        model_admin.message_user(request, format_html(
+            _("{0} messages in the <a href=\"{1}\">outbox</a> could not be sent."), failed, url,
+        ), messages.WARNING)
+
+
 class BookResource(ModelResource):
     """
     The django-import-export resource used to configure
@@ -69,6 +96,7 @@ class BookAdmin(ImportExportMixin, ModelAdmin):
         'author_truncated',
         'isbn_pretty',
         'number_of_orders',
+        'pending_order_count',
         'state',
     )
 
@@ -93,17 +121,11 @@ class BookAdmin(ImportExportMixin, ModelAdmin):
         }),
     ]
 
-    # Annotate the queryset with the number of orders.
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        qs = qs.annotate(Count('order'))
-        return qs
-
     # The number of orders for this book
     def number_of_orders(self, book):
-        return book.order__count
+        return book.order_count
 
-    number_of_orders.admin_order_field = 'order__count'
+    number_of_orders.admin_order_field = 'order_count'
     number_of_orders.short_description = _("# ord.")
 
     def accept_selected(self, request, queryset):
@@ -190,6 +212,9 @@ class OrderAdmin(ImportExportMixin, ModelAdmin):
         'status',
     )
 
+    # The related objects joined into the listed orders
+    list_select_related = Order.objects.listing_related
+
     # The keys that the list can be filtered by
     list_filter = (
         'status',
@@ -235,36 +260,39 @@ class OrderAdmin(ImportExportMixin, ModelAdmin):
 
     # The admin action for exporting to custom CSV
     def export(self, request, queryset):
-        response = HttpResponse(net_library_csv(queryset), content_type="text/csv")
+        response = StreamingHttpResponse(net_library_csv_chunks(queryset), content_type="text/csv")
         response['Content-Disposition'] = 'attachment; filename="export.csv"'
         return response
 
     export.short_description = _("Export orders to custom CSV")
 
+    # Sets status and hint of the selected orders in a single query,
+    # recounts the orders of their books and puts the notification mails
+    # into the outbox.
+    def update_selected(self, request, queryset, status, message_class):
+        pks = list(queryset.values_list('pk', flat=True))
+        with transaction.atomic():
+            orders = Order.objects.filter(pk__in=pks)
+            orders.update(
+                status=status,
+                hint=request.POST.get('hint', ""),
+            )
+            refresh_counters(Book, orders.values_list('book', flat=True).distinct())
+            if '_sendmails' in request.POST:
+                queued = len(queue_order_messages(message_class, pks))
+        if '_sendmails' in request.POST:
+            self.message_user(request, _("%(orders)d orders updated, %(messages)d notifications have been queued.") % {
+                'orders': len(pks), 'messages': queued,
+            })
+            warn_failed_messages(self, request)
+        else:
+            self.message_user(request, _("%d orders updated.") % len(pks))
+        return Order.objects.filter(pk__in=pks)
+
     # The admin action for rejecting all selected orders at once.
     def reject_selected(self, request, queryset):
         if request.POST.get('_proceed'):
-            errors = []
-            hint = request.POST.get('hint')
-            sendmails = '_sendmails' in request.POST
-            for order in queryset:
-                order.status = Order.REJECTED
-                order.hint = hint
-                order.save()
-                if sendmails:
-                    email = OrderRejectedMessage(order)
-                    try:
-                        email.send()
-                    except Exception:
-                        errors += [order.student.email]
-            if len(errors) > 0:
-                context = dict(
-                    self.admin_site.each_context(request),
-                    title=_("Errors"),
-                    intro=_("The following emails could not be sent"),
-                    errors=errors
-                )
-                return TemplateResponse(request, 'pyBuchaktion/admin/order_error.html', context)
+            self.update_selected(request, queryset, Order.REJECTED, OrderRejectedMessage)
         elif not request.POST.get('_cancel'):
             context = dict(
                 self.admin_site.each_context(request),
@@ -282,27 +310,7 @@ class OrderAdmin(ImportExportMixin, ModelAdmin):
     # The admin action for marking all selected orders as arrived.
     def mark_arrived_selected(self, request, queryset):
         if request.POST.get('_proceed'):
-            errors=[]
-            sendmails = '_sendmails' in request.POST
-            hint = request.POST.get('hint', "")
-            for order in queryset:
-                order.status = Order.ARRIVED
-                order.hint = hint
-                order.save()
-                if sendmails:
-                    email = OrderArrivedMessage(order)
-                    try:
-                        email.send()
-                    except Exception:
-                        errors += [order.student.email]
-            if len(errors) > 0:
-                context = dict(
-                    self.admin_site.each_context(request),
-                    title=_("Errors"),
-                    intro=_("The following emails could not be sent"),
-                    errors=errors
-                )
-                return TemplateResponse(request, 'pyBuchaktion/admin/order_error.html', context)
+            self.update_selected(request, queryset, Order.ARRIVED, OrderArrivedMessage)
         elif not request.POST.get('_cancel'):
             context = dict(
                 self.admin_site.each_context(request),
@@ -320,23 +328,11 @@ class OrderAdmin(ImportExportMixin, ModelAdmin):
     # The admin action for ordering the selected books
     def order_selected(self, request, queryset):
         if request.POST.get('_proceed'):
-            errors=[]
-            sendmails = '_sendmails' in request.POST
-            hint = request.POST.get('hint', "")
-            for order in queryset:
-                order.status = Order.ORDERED
-                order.hint = hint
-                order.save()
-                if sendmails:
-                    email = OrderAcceptedMessage(order)
-                    try:
-                        email.send()
-                    except Exception:
-                        errors += [order.student.email]
+            orders = self.update_selected(request, queryset, Order.ORDERED, OrderAcceptedMessage)
             context = dict(
                 self.admin_site.each_context(request),
                 title=_("Ordering: CSV-Export"),
-                queryset=queryset,
+                queryset=orders,
                 opts=self.opts,
                 errors=[],
                 action_checkbox_name=helpers.ACTION_CHECKBOX_NAME,
@@ -394,17 +390,11 @@ class StudentAdmin(ModelAdmin):
         }),
     ]
 
-    # Annotate the queryset with the number of orders.
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        qs = qs.annotate(Count('order'))
-        return qs
-
-    # The number of orders for this book
+    # The number of orders for this student
     def number_of_orders(self, student):
-        return student.order__count
+        return student.order_count
 
-    number_of_orders.admin_order_field = 'order__count'
+    number_of_orders.admin_order_field = 'order_count'
     number_of_orders.short_description = _("orders")
 
     def has_library_id(self, student):
@@ -418,9 +408,11 @@ class StudentAdmin(ModelAdmin):
         if request.POST.get('_proceed'):
             text = request.POST.get('text', "")
             if len(text) > 0:
-                for student in queryset:
-                    email = CustomMessage(student, text)
-                    email.send()
+                students = queryset.select_related('tuid_user')
+                fragments = MessageFragments()
+                OutboxMessage.objects.enqueue(CustomMessage(student, text, fragments) for student in students)
+                self.message_user(request, _("The message has been queued for %d students.") % len(students))
+                warn_failed_messages(self, request)
 
         elif not request.POST.get('_cancel'):
             context = dict(
@@ -494,18 +486,24 @@ class TUCaNLiteratureWidget(ManyToManyWidget):
     def __init__(self):
         super().__init__(Book, separator=', ', field='isbn_13')
 
+    def render(self, value, obj=None):
+        # Also accept plain lists, as planned by TUCaNLiteratureImport
+        books = value.all() if hasattr(value, 'all') else value
+        return self.separator.join(book.isbn_13 for book in books)
+
 
 class TUCaNLiteratureField(Field):
     def __init__(self):
         super().__init__(column_name='books', attribute='literature', widget=TUCaNLiteratureWidget())
 
-    def save(self, obj, data):
+    def save(self, obj, data, is_m2m=False):
         ids = []
         for book in self.clean(data):
             try:
                 literature_info = Literature.objects.get(book=book, module=obj)
                 if not literature_info.in_tucan:
-                    literature_info.update(in_tucan=True)
+                    literature_info.in_tucan = True
+                    literature_info.save(update_fields=['in_tucan'])
             except Literature.DoesNotExist:
                 literature_info = Literature.objects.create(
                     book=book, module=obj, source=Literature.TUCAN, in_tucan=True
@@ -516,6 +514,7 @@ class TUCaNLiteratureField(Field):
         literature = Literature.objects.filter(module=obj).exclude(pk__in=ids)
         literature.filter(source=Literature.TUCAN).delete()
         literature.filter(in_tucan=True).update(in_tucan=False)
+        refresh_counters(Module, [obj.pk])
 
     def get_value(self, obj):
         return Book.objects.filter(
@@ -524,11 +523,155 @@ class TUCaNLiteratureField(Field):
         )
 
 
+class TUCaNLiteratureImport(object):
+    """
+    The bulk version of TUCaNLiteratureField.save for a whole dataset.
+    All referenced books and the existing literature of the imported modules
+    are loaded up front, the changes for each row are only collected and
+    then written by flush() in a few bulk queries.
+    """
+
+    def __init__(self, dataset, field):
+        self.field = field
+        isbns = set()
+        if field.column_name in dataset.headers:
+            for value in dataset[field.column_name]:
+                isbns.update(self.isbns(value))
+        self.books = {
+            book.isbn_13: book for book in Book.objects.filter(isbn_13__in=isbns)
+        }
+
+        self.literature = defaultdict(dict)
+        if 'module_id' in dataset.headers:
+            literature = Literature.objects \
+                .filter(module__module_id__in=set(dataset['module_id'])) \
+                .select_related('book', 'module')
+            for literature_info in literature:
+                self.literature[literature_info.module.module_id][literature_info.book_id] = literature_info
+
+        self.planned = {}
+        self.modules = set()
+        self.created = []
+        self.in_tucan = set()
+        self.deleted = set()
+        self.not_in_tucan = set()
+
+    def isbns(self, value):
+        if not value:
+            return []
+        return [isbn.strip() for isbn in str(value).split(self.field.widget.separator) if isbn.strip()]
+
+    def save(self, module, data):
+        existing = self.literature[module.module_id]
+        books = []
+        for isbn in self.isbns(data.get(self.field.column_name)):
+            book = self.books.get(isbn)
+            if book is None or book in books:
+                continue
+            books.append(book)
+            literature_info = existing.get(book.pk)
+            if literature_info is None:
+                self.created.append(Literature(
+                    book=book, module=module, source=Literature.TUCAN, in_tucan=True
+                ))
+            elif not literature_info.in_tucan:
+                self.in_tucan.add(literature_info.pk)
+
+        kept = set(book.pk for book in books)
+        for book_id, literature_info in existing.items():
+            if book_id in kept:
+                continue
+            if literature_info.source == Literature.TUCAN:
+                self.deleted.add(literature_info.pk)
+            elif literature_info.in_tucan:
+                self.not_in_tucan.add(literature_info.pk)
+        self.planned[module.module_id] = books
+        self.modules.add(module.pk)
+
+    def get_value(self, module):
+        if module.module_id in self.planned:
+            return self.planned[module.module_id]
+        return [
+            literature_info.book
+            for literature_info in self.literature[module.module_id].values()
+            if literature_info.in_tucan
+        ]
+
+    def flush(self):
+        with transaction.atomic():
+            Literature.objects.bulk_create(self.created)
+            Literature.objects.filter(pk__in=self.in_tucan).update(in_tucan=True)
+            Literature.objects.filter(pk__in=self.deleted).delete()
+            Literature.objects.filter(pk__in=self.not_in_tucan).update(in_tucan=False)
+            refresh_counters(Module, self.modules)
+
+
+class ModuleInstanceLoader(CachedInstanceLoader):
+
+    def get_queryset(self):
+        return self.resource.get_queryset()
+
+
 class ModuleResource(ForeignKeyImportResourceMixin, ModelResource):
+
+    # The bulk literature import of the dataset currently being imported
+    literature_import = None
+
+    # The categories and semesters of the current import by their cell value
+    foreign_objects = None
+
     def get_queryset(self):
-        queryset = super().get_queryset()
-        queryset.prefetch_related(Prefetch('literature'))
-        return queryset
+        # The original modules are exported for the diff of each row
+        return super().get_queryset().select_related('category', 'last_offered')
+
+    def import_data(self, *args, **kwargs):
+        queries = CaptureQueriesContext(connection)
+        started = time.time()
+        with ExitStack() as stack:
+            # Recording the queries is only cheap enough when debugging
+            if settings.DEBUG:
+                stack.enter_context(queries)
+            result = super().import_data(*args, **kwargs)
+        elapsed = time.time() - started
+        if settings.DEBUG:
+            logger.info("Imported %d modules in %.2fs with %d queries", result.total_rows, elapsed, len(queries))
+        else:
+            logger.info("Imported %d modules in %.2fs", result.total_rows, elapsed)
+        return result
+
+    def before_import(self, dataset, using_transactions, dry_run, **kwargs):
+        super().before_import(dataset, using_transactions, dry_run, **kwargs)
+        self.literature_import = TUCaNLiteratureImport(dataset, self.fields['books'])
+        self.foreign_objects = {'category': {}, 'last_offered': {}}
+
+    def import_field(self, field, obj, data, is_m2m=False):
+        if field is self.fields['books'] and self.literature_import:
+            if field.column_name in data:
+                self.literature_import.save(obj, data)
+        elif self.foreign_objects and field.column_name in self.foreign_objects and field.column_name in data:
+            # Most modules share a few categories and semesters, which are
+            # only looked up once per import
+            cache = self.foreign_objects[field.column_name]
+            value = data[field.column_name]
+            if value not in cache:
+                cache[value] = field.clean(data)
+            setattr(obj, field.attribute, cache[value])
+        else:
+            super().import_field(field, obj, data, is_m2m)
+
+    def dehydrate_books(self, obj):
+        field = self.fields['books']
+        if self.literature_import:
+            return field.widget.render(self.literature_import.get_value(obj))
+        return field.export(obj)
+
+    def after_import(self, dataset, result, using_transactions, dry_run, **kwargs):
+        super().after_import(dataset, result, using_transactions, dry_run, **kwargs)
+        # A dry run only previews the literature, see dehydrate_books
+        if self.literature_import and not dry_run:
+            self.literature_import.flush()
+        self.literature_import = None
+        self.foreign_objects = None
 
     books = TUCaNLiteratureField()
     category = Field(
@@ -548,6 +691,7 @@ class ModuleResource(ForeignKeyImportResourceMixin, ModelResource):
 
     class Meta:
         model = Module
+        instance_loader_class = ModuleInstanceLoader
         import_id_fields = (
             'module_id',
         )
@@ -576,6 +720,11 @@ class ModuleAdmin(ImportExportMixin, ModelAdmin):
         'category',
     )
 
+    # The category is optional, so it is not joined automatically
+    list_select_related = (
+        'category',
+    )
+
     search_fields = [
         'name_de',
         'name_en',
@@ -714,3 +863,45 @@ class DisplayMessageAdmin(ImportExportMixin, ModelAdmin):
         return Truncator(obj.text_en).chars(60)
 
     trunc_en.short_description = _("english text")
+
+
+@register(OutboxMessage)
+class OutboxMessageAdmin(ModelAdmin):
+    """
+        The admin for the mail outbox displays the delivery state of
+        the queued messages and allows to retry failed ones.
+    """
+
+    list_display = (
+        'subject',
+        'to',
+        'state',
+        'attempts',
+        'next_attempt',
+        'sent',
+    )
+
+    list_filter = (
+        'state',
+    )
+
+    readonly_fields = (
+        'created',
+        'sent',
+        'last_error',
+    )
+
+    actions = (
+        'retry_selected',
+    )
+
+    # The admin action for sending the selected messages again
+    def retry_selected(self, request, queryset):
+        count = queryset.exclude(state=OutboxMessage.SENT).update(
+            state=OutboxMessage.PENDING,
+            attempts=0,
+            next_attempt=timezone.now(),
+        )
+        self.message_user(request, _("%d messages will be sent again.") % count)
+
+    retry_selected.short_description = _("retry selected messages")
@@ -3,3 +3,7 @@ from django.apps import AppConfig
 
 class PybuchaktionConfig(AppConfig):
     name = 'pyBuchaktion'
+
+    def ready(self):
+        # Connect the signal handlers that invalidate the message cache
+        from . import messages  # noqa
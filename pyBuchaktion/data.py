@@ -1,10 +1,21 @@
 import io
 import csv
 
-def net_library_csv(queryset):
+# The number of orders written per chunk of a streamed export
+NET_LIBRARY_CSV_CHUNK_SIZE = 500
+
+
+def net_library_csv_chunks(queryset, chunk_size=NET_LIBRARY_CSV_CHUNK_SIZE):
+    """
+    Yields the net library CSV of the given orders in chunks of `chunk_size`
+    lines. Student and book are joined into the order query, which is
+    iterated without caching, so neither the query count nor the memory
+    grows with the number of orders.
+    """
     out_stream = io.StringIO()
     writer = csv.writer(out_stream, delimiter='|', quotechar="\"", quoting=csv.QUOTE_MINIMAL)
-    for order in queryset:
+    orders = queryset.select_related('student', 'book').iterator()
+    for count, order in enumerate(orders, 1):
         array = [
             order.student.library_id,
             order.book.author,
@@ -14,5 +25,15 @@ def net_library_csv(queryset):
             order.book.isbn_13
         ]
         writer.writerow(array)
+        if count % chunk_size == 0:
+            yield out_stream.getvalue()
+            out_stream.seek(0)
+            out_stream.truncate()
 
-    return out_stream.getvalue()
+    rest = out_stream.getvalue()
+    if rest:
+        yield rest
+
+
+def net_library_csv(queryset):
+    return ''.join(net_library_csv_chunks(queryset))
@@ -36,16 +36,11 @@ class BookOrderForm(forms.ModelForm):
         # if Order.objects.student_book_order_count(student, book) > 0:
         #    raise ValidationError(_("You already ordered this book"), code='already_ordered')
 
-        timeframe = models.OrderTimeframe.objects.current()
-        if not timeframe:
+        budget = student.budget()
+        if not budget.current_timeframe:
             raise ValidationError(_("Book ordering is not active for the current date"), code='no_timeframe')
 
-        semester = timeframe.semester
-        budget_spent = models.Order.objects.student_semester_order_count(student, semester)
-        budget_max = models.OrderTimeframe.objects.semester_budget(semester)
-        budget_left = budget_max - budget_spent
-
-        if budget_left <= 0:
+        if budget.left <= 0:
             raise ValidationError(_("You may not order any more books in this timeframe."), code='no_budget_left')
 
 
@@ -99,17 +94,12 @@ class BookProposeForm(forms.ModelForm):
         if not isbnlib.is_isbn13(cleaned_data['isbn_13']):
             raise ValidationError({'isbn_13': _("Not a valid ISBN-13")}, code='isbn_invalid')
 
-        # Get the current timeframe
-        timeframe = models.OrderTimeframe.objects.current()
-        if not timeframe:
+        # Get the budget for the current timeframe
+        budget = student.budget()
+        if not budget.current_timeframe:
             raise ValidationError(_("Book proposal is not active for the current date."), code='no_timeframe')
 
-        semester = timeframe.semester
-        budget_spent = models.Order.objects.student_semester_order_count(student, semester)
-        budget_max = models.OrderTimeframe.objects.semester_budget(semester)
-        budget_left = budget_max - budget_spent
-
-        if budget_left <= 0:
+        if budget.left <= 0:
             raise ValidationError(_("You may not order or propose any more books in this timeframe."), code='no_budget_left')
 
         return cleaned_data
@@ -1,18 +1,66 @@
+import logging
+
 from django.utils import translation
 from django.utils.translation import ugettext as _
+from django.core.mail import get_connection
 from django.core.mail.message import EmailMessage
 from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
 
+from .models import Order, OutboxMessage
+from .settings import BUCHAKTION_MAIL_BATCH_SIZE
+
+
+logger = logging.getLogger(__name__)
+
+
+def escape(text):
+    """
+    Escapes the braces in a text that becomes part of a message template.
+    """
+    return text.replace('{', '{{').replace('}', '}}')
+
+
+class MessageFragments(object):
+    """
+    The parts of a message that are the same for all recipients of a batch,
+    such as subject, sign and status text. Each part is rendered once per
+    language and message class and then reused by all messages sharing the
+    fragments.
+    """
+
+    def __init__(self):
+        self.cache = {}
+
+    def get(self, message, name, render):
+        key = (translation.get_language(), type(message), name)
+        try:
+            return self.cache[key]
+        except KeyError:
+            value = self.cache[key] = render()
+            return value
+
 
 class BuchaktionMessage(EmailMessage):
 
+    """
+    A message to a student. Subject and body are rendered once as a template
+    for all messages of a batch with the same languages and template key and
+    only the values of get_values() are filled in for each message.
+    """
+
     def get_content(self):
-        return _('This message does not have any content')
+        return escape(_('This message does not have any content'))
 
     def get_body(self):
-        return self.get_intro().format(self.student.tuid_user.name()) \
-                    + "\n\n" + self.get_content() + "\n\n" + _(self.get_sign())
+        return escape(self.fragment('intro', self.get_intro)).replace('{{0}}', '{name}') \
+                    + "\n\n" + self.get_content() + "\n\n" + escape(self.fragment('sign', lambda: _(self.get_sign())))
+
+    def get_values(self):
+        return {'name': self.student.tuid_user.name()}
+
+    def get_template_key(self):
+        return ()
 
     def get_tag(self):
         return "[Buchaktion]"
@@ -29,71 +77,103 @@ class BuchaktionMessage(EmailMessage):
     def get_subject(self):
         return "No Subject"
 
-    def __init__(self, student):
+    def fragment(self, name, render):
+        return self.fragments.get(self, name, render)
+
+    def render_template(self, maillangs):
+        f_subject = []
+        f_body = []
+
+        for lang in maillangs:
+            with translation.override(lang):
+                f_subject += [self.fragment('subject', self.get_subject),]
+                f_body += [self.get_body(),]
+
+        return self.get_tag() + " " + " / ".join(f_subject), ("\n\n" + "-" * 30 + "\n\n").join(f_body)
+
+    def __init__(self, student, fragments=None):
 
         self.student = student
+        self.fragments = fragments or MessageFragments()
 
         super().__init__(
             to = [student.tuid_user.email,]
         )
 
-        f_subject = []
-        f_body = []
-
         userlang = student.language
         if userlang:
             maillangs = (userlang,)
         else:
             maillangs = ('de', 'en')
 
-        for lang in maillangs:
-            with translation.override(lang):
-                f_subject += [self.get_subject(),]
-                f_body += [self.get_body(),]
-
-        self.subject = self.get_tag() + " " + " / ".join(f_subject)
-        self.body = ("\n\n" + "-" * 30 + "\n\n").join(f_body)
+        self.subject, body = self.fragment(
+            ('template', maillangs, self.get_template_key()), lambda: self.render_template(maillangs)
+        )
+        self.body = body.format(**self.get_values())
         self.reply_to = self.get_reply_to()
 
 
 class CustomMessage(BuchaktionMessage):
 
     def get_content(self):
-        return _(self.content)
+        return escape(self.fragment(('content', self.content), lambda: _(self.content)))
 
-    def __init__(self, student, content):
+    def get_template_key(self):
+        return (self.content,)
+
+    def __init__(self, student, content, fragments=None):
         self.content = content
-        super().__init__(student)
+        super().__init__(student, fragments)
 
 class OrderStatusMessage(BuchaktionMessage):
 
     def get_status_message(self):
         return ""
 
+    def get_labels(self):
+        return _("Title"), _("Author"), _("Published"), _("ISBN-13"), _("Hint")
+
+    def get_link(self):
+        domain, label = self.fragment('link', lambda: (Site.objects.get_current().domain, _("View Order")))
+        return "<a href=\"https://" + escape(domain) + "{url}\">" + escape(label) + "</a>"
+
     def get_content(self):
-        book = self.order.book
+        title, author, published, isbn, hint = map(escape, self.fragment('labels', self.get_labels))
 
         fields = (
-            (_("Title"), book.title),
-            (_("Author"), book.author),
-            (_("Published"), ', '.join([book.publisher, str(book.year)])),
-            (_("ISBN-13"), book.isbn_13),
+            (title, '{title}'),
+            (author, '{author}'),
+            (published, '{published}'),
+            (isbn, '{isbn}'),
         )
 
-        content = self.get_status_message() + "\n"*2
+        content = escape(self.fragment('status', self.get_status_message)) + "\n"*2
         content += "\n".join([key + ': ' + value for key, value in fields])
         if self.order.hint:
-            content += "\n" + _("Hint") + ": " + self.order.hint
-        content += "\n" + "<a href=\"https://{0}{1}\">{2}</a>".format(
-                    Site.objects.get_current().domain,
-                    reverse("pyBuchaktion:order", kwargs={'pk': self.order.pk}),
-                    _("View Order"))
+            content += "\n" + hint + ": {hint}"
+        content += "\n" + self.get_link()
 
         return content
 
-    def __init__(self, order):
+    def get_values(self):
+        book = self.order.book
+        values = super().get_values()
+        values.update(
+            title=book.title,
+            author=book.author,
+            published=', '.join([book.publisher, str(book.year)]),
+            isbn=book.isbn_13,
+            hint=self.order.hint,
+            url=reverse("pyBuchaktion:order", kwargs={'pk': self.order.pk}),
+        )
+        return values
+
+    def get_template_key(self):
+        return (bool(self.order.hint),)
+
+    def __init__(self, order, fragments=None):
         self.order = order
-        super().__init__(order.student)
+        super().__init__(order.student, fragments)
 
 
 class OrderAcceptedMessage(OrderStatusMessage):
@@ -124,3 +204,49 @@ class OrderArrivedMessage(OrderStatusMessage):
 
     def get_subject(self):
         return _("Order arrived")
+
+
+def queue_order_messages(message_class, order_pks):
+    """
+    Puts a message of the given class for each of the given orders into
+    the outbox. The messages share their fragments, so the template is
+    rendered once per language and only the values of each order are
+    filled in.
+    """
+    orders = Order.objects.filter(pk__in=order_pks) \
+        .select_related('book', 'student', 'student__tuid_user')
+    fragments = MessageFragments()
+    return OutboxMessage.objects.enqueue(message_class(order, fragments) for order in orders)
+
+
+def send_outbox(batch_size=BUCHAKTION_MAIL_BATCH_SIZE):
+    """
+    Claims the next batch of due messages in the outbox, sends them over a
+    single mail connection and records the delivery state of each of them.
+    Returns the number of messages processed.
+    """
+    batch = OutboxMessage.objects.claim(batch_size)
+    if not batch:
+        return 0
+
+    mail_connection = get_connection()
+    try:
+        mail_connection.open()
+    except Exception as error:
+        logger.warning("Could not connect to the mail server: %s", error)
+        for message in batch:
+            message.failed(error)
+        return len(batch)
+
+    try:
+        for message in batch:
+            try:
+                mail_connection.send_messages([message.email_message()])
+            except Exception as error:
+                logger.warning("Could not send message %d: %s", message.pk, error)
+                message.failed(error)
+            else:
+                message.delivered()
+    finally:
+        mail_connection.close()
+    return len(batch)
@@ -0,0 +1,45 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.db.models import F
+
+from pyBuchaktion.models import get_counters, counter_value, refresh_counters
+
+
+class Command(BaseCommand):
+    help = "Rebuilds or verifies the order, literature and module counters."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--verify', action='store_true', dest='verify', default=False,
+            help="Only report the counters that are off instead of rebuilding them.",
+        )
+
+    def handle(self, *args, **options):
+        if options['verify']:
+            self.verify()
+        else:
+            self.rebuild()
+
+    def rebuild(self):
+        models = []
+        for model, field, counted, lookup in get_counters():
+            if model not in models:
+                models.append(model)
+        with transaction.atomic():
+            for model in models:
+                count = refresh_counters(model)
+                self.stdout.write("Recounted %d %s" % (count, model._meta.verbose_name_plural))
+
+    def verify(self):
+        errors = 0
+        for model, field, counted, lookup in get_counters():
+            wrong = model.objects \
+                .annotate(actual=counter_value(counted, lookup)) \
+                .exclude(**{field: F('actual')}) \
+                .count()
+            if wrong:
+                self.stderr.write("%s.%s is off for %d rows" % (model.__name__, field, wrong))
+            errors += wrong
+        if errors:
+            raise CommandError("Found %d wrong counters, run the command without --verify to rebuild them" % errors)
+        self.stdout.write("All counters are correct")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from pyBuchaktion.models import Book, BookSearchToken, Module, ModuleSearchToken
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the search indexes of all books and modules."
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            books = BookSearchToken.objects.rebuild(Book.objects.all())
+            modules = ModuleSearchToken.objects.rebuild(Module.objects.all())
+        self.stdout.write("Indexed %d book and %d module tokens" % (books, modules))
@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from pyBuchaktion.mail import send_outbox
+from pyBuchaktion.settings import BUCHAKTION_MAIL_BATCH_SIZE
+
+
+class Command(BaseCommand):
+    help = "Sends the messages waiting in the Buchaktion mail outbox."
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size', type=int, default=BUCHAKTION_MAIL_BATCH_SIZE,
+            help="The number of messages sent over one mail connection.",
+        )
+        parser.add_argument(
+            '--loop', type=float, metavar='SECONDS', default=0,
+            help="Keep running and check the outbox every SECONDS.",
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            count = 0
+            processed = options['batch_size']
+            while processed and processed == options['batch_size']:
+                processed = send_outbox(options['batch_size'])
+                count += processed
+            if count:
+                self.stdout.write("Processed %d messages" % count)
+            if not options['loop']:
+                break
+            time.sleep(options['loop'])
@@ -1,6 +1,13 @@
+import time
+
+from django.core.cache import caches
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
 from django.utils.translation import ugettext_lazy as _
 
-from .settings import BUCHAKTION_MESSAGES_DEBUG
+from .settings import BUCHAKTION_MESSAGES_DEBUG, BUCHAKTION_MESSAGES_CACHE
+from .settings import BUCHAKTION_MESSAGES_CACHE_TIMEOUT
 from .models import DisplayMessage
 
 MESSAGES = {
@@ -26,6 +33,64 @@ MESSAGES = {
     'book_not_found_all':           _('You may propose the book to us <a href="{propose}">here</a>, or contact us via E-Mail at <a href="mailto:{email}">{email}</a>')
 }
 
+# The key of the display messages in the shared cache
+DISPLAY_MESSAGES_CACHE_KEY = 'pyBuchaktion:display_messages'
+
+# The display messages as (load time, messages by key), loaded on first use
+_display_messages = None
+
+
+def get_display_messages():
+
+    """
+    Gets all display messages by key. They are loaded with a single query
+    and then kept in memory, or in the BUCHAKTION_MESSAGES_CACHE to share
+    them between processes, for up to BUCHAKTION_MESSAGES_CACHE_TIMEOUT
+    seconds.
+    """
+
+    global _display_messages
+    if BUCHAKTION_MESSAGES_CACHE:
+        cache = caches[BUCHAKTION_MESSAGES_CACHE]
+        display_messages = cache.get(DISPLAY_MESSAGES_CACHE_KEY)
+        if display_messages is None:
+            display_messages = {message.key: message for message in DisplayMessage.objects.all()}
+            cache.set(DISPLAY_MESSAGES_CACHE_KEY, display_messages, BUCHAKTION_MESSAGES_CACHE_TIMEOUT)
+        return display_messages
+
+    now = time.monotonic()
+    if _display_messages is None or (
+            BUCHAKTION_MESSAGES_CACHE_TIMEOUT is not None
+            and now - _display_messages[0] > BUCHAKTION_MESSAGES_CACHE_TIMEOUT):
+        _display_messages = (now, {message.key: message for message in DisplayMessage.objects.all()})
+    return _display_messages[1]
+
+
+def drop_display_messages():
+
+    """
+    Drops the display messages from memory and from the shared cache.
+    """
+
+    global _display_messages
+    _display_messages = None
+    if BUCHAKTION_MESSAGES_CACHE:
+        caches[BUCHAKTION_MESSAGES_CACHE].delete(DISPLAY_MESSAGES_CACHE_KEY)
+
+
+@receiver(post_save, sender=DisplayMessage)
+@receiver(post_delete, sender=DisplayMessage)
+def invalidate_display_messages(sender, **kwargs):
+
+    """
+    Drops the cached display messages whenever one of them changes. This
+    waits for the commit, otherwise a concurrent request could cache the
+    old messages again before the change is visible to it.
+    """
+
+    transaction.on_commit(drop_display_messages)
+
+
 def get_message(key):
 
     """
@@ -40,7 +105,7 @@ def get_message(key):
         # raise RuntimeException('Empty message key not allowed')
 
     # Try the display message objects
-    display_message = DisplayMessage.objects.filter(key=key).first()
+    display_message = get_display_messages().get(key)
     if display_message:
         return display_message.text()
 
@@ -75,4 +140,4 @@ class Message(object):
 
     # Gets the represented message
     def __repr__(self):
-        return get_message(self.key)
+        return str(get_message(self.key))
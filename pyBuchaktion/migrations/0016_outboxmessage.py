@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 10:56
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyBuchaktion', '0015_auto_20170713_0649'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('subject', models.TextField(verbose_name='subject')),
+                ('body', models.TextField(verbose_name='body')),
+                ('to', models.TextField(verbose_name='recipients')),
+                ('reply_to', models.TextField(blank=True, verbose_name='reply to')),
+                ('state', models.CharField(choices=[('PD', 'Pending'), ('ST', 'Sent'), ('FL', 'Failed')], default='PD', max_length=2, verbose_name='state')),
+                ('attempts', models.PositiveIntegerField(default=0, verbose_name='attempts')),
+                ('next_attempt', models.DateTimeField(default=django.utils.timezone.now, verbose_name='next attempt')),
+                ('last_error', models.TextField(blank=True, verbose_name='last error')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('sent', models.DateTimeField(blank=True, null=True, verbose_name='sent')),
+            ],
+            options={
+                'verbose_name': 'outbox message',
+                'verbose_name_plural': 'outbox messages',
+            },
+        ),
+    ]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 11:03
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+import isbnlib
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# A frozen copy of the tokenizer in pyBuchaktion.search, so that this
+# migration keeps building the same index when the tokenizer changes
+
+WORD_REGEX = re.compile(r'\w+')
+ISBN_REGEX = re.compile(r'[^0-9X]')
+
+
+def fold(text):
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return [word[:64] for word in WORD_REGEX.findall(fold(text or ""))]
+
+
+def book_tokens(book):
+    tokens = set()
+    for field, text in (('T', book.title), ('A', book.author), ('P', book.publisher)):
+        tokens.update((field, token) for token in tokenize(text))
+    isbn = ISBN_REGEX.sub("", (book.isbn_13 or "").upper())
+    if isbn:
+        tokens.add(('I', isbn))
+        isbn_10 = isbnlib.to_isbn10(isbn) if isbnlib.is_isbn13(isbn) else None
+        if isbn_10:
+            tokens.add(('I', isbn_10))
+    return tokens
+
+
+def index_books(apps, schema_editor):
+    Book = apps.get_model('pyBuchaktion', 'Book')
+    BookSearchToken = apps.get_model('pyBuchaktion', 'BookSearchToken')
+    # Small batches, SQLite allows only a few hundred rows per statement
+    BookSearchToken.objects.bulk_create((
+        BookSearchToken(book=book, field=field, token=token)
+        for book in Book.objects.iterator()
+        for field, token in book_tokens(book)
+    ), batch_size=250)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyBuchaktion', '0016_outboxmessage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BookSearchToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('T', 'title'), ('A', 'author'), ('P', 'publisher'), ('I', 'ISBN')], max_length=1, verbose_name='field')),
+                ('token', models.CharField(max_length=64, verbose_name='token')),
+                ('book', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='pyBuchaktion.Book', verbose_name='book')),
+            ],
+            options={
+                'verbose_name': 'search token',
+                'verbose_name_plural': 'search tokens',
+            },
+        ),
+        migrations.AlterIndexTogether(
+            name='booksearchtoken',
+            index_together=set([('field', 'token')]),
+        ),
+        migrations.RunPython(index_books, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 11:04
+from __future__ import unicode_literals
+
+import re
+import unicodedata
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+# A frozen copy of the tokenizer in pyBuchaktion.search, so that this
+# migration keeps building the same index when the tokenizer changes
+
+WORD_REGEX = re.compile(r'\w+')
+MODULE_ID_REGEX = re.compile(r'\W|_')
+
+
+def fold(text):
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return [word[:64] for word in WORD_REGEX.findall(fold(text or ""))]
+
+
+def module_tokens(module):
+    tokens = set(('N', token) for token in tokenize(module.name_de) + tokenize(module.name_en))
+    module_id = MODULE_ID_REGEX.sub("", fold(module.module_id or ""))[:64]
+    if module_id:
+        tokens.add(('M', module_id))
+    return tokens
+
+
+def index_modules(apps, schema_editor):
+    Module = apps.get_model('pyBuchaktion', 'Module')
+    ModuleSearchToken = apps.get_model('pyBuchaktion', 'ModuleSearchToken')
+    for module in Module.objects.iterator():
+        Module.objects.filter(pk=module.pk).update(literature_count=module.literature_info.count())
+    # Small batches, SQLite allows only a few hundred rows per statement
+    ModuleSearchToken.objects.bulk_create((
+        ModuleSearchToken(module=module, field=field, token=token)
+        for module in Module.objects.iterator()
+        for field, token in module_tokens(module)
+    ), batch_size=250)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyBuchaktion', '0017_booksearchtoken'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ModuleSearchToken',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('field', models.CharField(choices=[('N', 'name'), ('M', 'module id')], max_length=1, verbose_name='field')),
+                ('token', models.CharField(max_length=64, verbose_name='token')),
+            ],
+            options={
+                'verbose_name': 'search token',
+                'verbose_name_plural': 'search tokens',
+            },
+        ),
+        migrations.AddField(
+            model_name='module',
+            name='literature_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='literature count'),
+        ),
+        migrations.AddField(
+            model_name='modulesearchtoken',
+            name='module',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_tokens', to='pyBuchaktion.Module', verbose_name='module'),
+        ),
+        migrations.AlterIndexTogether(
+            name='modulesearchtoken',
+            index_together=set([('field', 'token')]),
+        ),
+        migrations.RunPython(index_modules, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.11.29 on 2026-10-17 11:08
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def counter_value(counted, lookup):
+    count = counted \
+        .filter(**{lookup: OuterRef('pk')}) \
+        .order_by() \
+        .values(lookup) \
+        .annotate(count=Count('pk')) \
+        .values('count')
+    return Coalesce(Subquery(count, output_field=models.IntegerField()), 0)
+
+
+def count(apps, schema_editor):
+    Book = apps.get_model('pyBuchaktion', 'Book')
+    Student = apps.get_model('pyBuchaktion', 'Student')
+    Order = apps.get_model('pyBuchaktion', 'Order')
+    Module = apps.get_model('pyBuchaktion', 'Module')
+    ModuleCategory = apps.get_model('pyBuchaktion', 'ModuleCategory')
+    orders = Order.objects.all()
+    Book.objects.update(
+        order_count=counter_value(orders, 'book'),
+        pending_order_count=counter_value(orders.filter(status='PD'), 'book'),
+        ordered_order_count=counter_value(orders.filter(status='OD'), 'book'),
+        rejected_order_count=counter_value(orders.filter(status='RJ'), 'book'),
+        arrived_order_count=counter_value(orders.filter(status='AR'), 'book'),
+    )
+    Student.objects.update(order_count=counter_value(orders, 'student'))
+    ModuleCategory.objects.update(module_count=counter_value(Module.objects.all(), 'category'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pyBuchaktion', '0018_modulesearchtoken'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='book',
+            name='arrived_order_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='arrived orders'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='order_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='orders'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='ordered_order_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='ordered orders'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='pending_order_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='pending orders'),
+        ),
+        migrations.AddField(
+            model_name='book',
+            name='rejected_order_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='rejected orders'),
+        ),
+        migrations.AddField(
+            model_name='modulecategory',
+            name='module_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='module count'),
+        ),
+        migrations.AddField(
+            model_name='student',
+            name='order_count',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='orders'),
+        ),
+        migrations.RunPython(count, migrations.RunPython.noop),
+    ]
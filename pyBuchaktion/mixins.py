@@ -107,6 +107,37 @@ class SearchFormContextMixin(ContextMixin):
 
 
 class ForeignKeyImportResourceMixin(object):
+    """
+    Allows import columns like `book__isbn_13` to reference foreign objects
+    by one of their fields. The objects referenced by a dataset are loaded
+    in before_import with a single query per column.
+    """
+
+    # The prefetched foreign objects of the current import by column and value
+    foreign_key_cache = None
+
+    def before_import(self, dataset, *args, **kwargs):
+        super().before_import(dataset, *args, **kwargs)
+        self.foreign_key_cache = {}
+        for key in dataset.headers or ():
+            target = key.split("__", 1)
+            if len(target) < 2:
+                continue
+            field_name, target_query = target
+            foreign_model = self._meta.model._meta.get_field(field_name).rel.to
+            values = set(value for value in dataset[key] if value not in (None, ''))
+            queryset = foreign_model.objects.filter(**{target_query + '__in': values})
+            if "__" in target_query:
+                queryset = queryset.select_related(target_query.rsplit("__", 1)[0])
+            self.foreign_key_cache[key] = {
+                str(self.foreign_key_value(obj, target_query)): obj for obj in queryset
+            }
+
+    @staticmethod
+    def foreign_key_value(obj, target_query):
+        for attribute in target_query.split("__"):
+            obj = getattr(obj, attribute)
+        return obj
 
     def init_instance(self, row=None):
         """
@@ -119,9 +150,13 @@ class ForeignKeyImportResourceMixin(object):
                 field_name = target[0]
                 if len(target) > 1:
                     target_query = target[1]
-                    foreign_model = self._meta.model._meta.get_field(field_name).rel.to
-                    args = {target_query: row[key]}
-                    setattr(instance, field_name, foreign_model.objects.get(**args))
+                    cache = (self.foreign_key_cache or {}).get(key, {})
+                    foreign_object = cache.get(str(row[key]))
+                    if foreign_object is None:
+                        foreign_model = self._meta.model._meta.get_field(field_name).rel.to
+                        args = {target_query: row[key]}
+                        foreign_object = foreign_model.objects.get(**args)
+                    setattr(instance, field_name, foreign_object)
 
         return instance
 
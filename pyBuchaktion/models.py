@@ -9,22 +9,88 @@
     Timeframes are linked to a semester/term for budget calculations.
     Finally the Module model represents modules such as readings
     which may define literature recommendations as a list of books.
+
+    Books and modules are searched through indexes of their tokens, which
+    are kept up to date whenever a book or module is saved.
+
+    Notification mails are not sent directly, but are put into the
+    outbox and sent by the `buchaktion_sendmail` management command.
 """
 
-from datetime import datetime
+import copy
+import time
+import uuid
+import difflib
+import threading
+
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 from isbnlib import mask
 
-from django.db import models
-from django.db.models import Sum, Prefetch
-from django.db.models.signals import pre_save
+from django.core.cache import caches
+from django.db import connections, models, transaction
+from django.db.models import Sum, Count, Prefetch, OuterRef, Subquery, Case, When, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_save, post_save, post_delete, post_init
+from django.core.exceptions import ValidationError
+from django.core.mail.message import EmailMessage
 from django.core.urlresolvers import reverse
+from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import get_language
 from django.dispatch import receiver
 
 from pyTUID.models import TUIDUser
 
-class Book(models.Model):
+from . import search
+from .settings import BUCHAKTION_MAIL_MAX_ATTEMPTS, BUCHAKTION_MAIL_RETRY_DELAY, BUCHAKTION_MAIL_CLAIM_TIMEOUT
+from .settings import BUCHAKTION_TIMEFRAME_CACHE_TIMEOUT
+from .settings import BUCHAKTION_MODULES_CACHE
+
+class CountedQuerySet(models.QuerySet):
+
+    """
+        A queryset of rows that are counted by other models, or that cascade
+        to such rows. Deleting it refreshes each affected counter once,
+        instead of once per deleted row.
+    """
+
+    def delete(self):
+        with deferred_counters():
+            return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class CountedModel(models.Model):
+
+    """
+        A model with counter columns that are kept up to date by the
+        signals, see get_counters(). A full save of an existing row leaves
+        the counters out, so it cannot write back the outdated counts the
+        instance was loaded with.
+    """
+
+    # The names of the counter fields of the model
+    counter_fields = ()
+
+    def save(self, force_insert=False, force_update=False, using=None, update_fields=None):
+        if update_fields is None and not (force_insert or self._state.adding):
+            deferred = self.get_deferred_fields()
+            update_fields = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.attname not in deferred and field.name not in self.counter_fields
+            ]
+        super().save(force_insert, force_update, using, update_fields)
+
+    class Meta:
+        abstract = True
+
+
+class Book(CountedModel):
 
     """
         A single book that may be ordered if activated. Books are uniquely
@@ -36,6 +102,9 @@ class Book(models.Model):
         available (obsolete) or has just been proposed for ordering.
     """
 
+    # Deleting books in bulk cascades to their literature entries
+    objects = CountedQuerySet.as_manager()
+
     # The International Serial Book Number in the 13 digit version.
     isbn_13 = models.CharField(
         max_length=13,
@@ -102,6 +171,16 @@ class Book(models.Model):
         blank=True,
     )
 
+    # The number of orders for this book, in total and per order status,
+    # kept up to date by the order signals
+    order_count = models.PositiveIntegerField(default=0, editable=False, verbose_name=_("orders"))
+    pending_order_count = models.PositiveIntegerField(default=0, editable=False, verbose_name=_("pending orders"))
+    ordered_order_count = models.PositiveIntegerField(default=0, editable=False, verbose_name=_("ordered orders"))
+    rejected_order_count = models.PositiveIntegerField(default=0, editable=False, verbose_name=_("rejected orders"))
+    arrived_order_count = models.PositiveIntegerField(default=0, editable=False, verbose_name=_("arrived orders"))
+
+    counter_fields = ('order_count', 'pending_order_count', 'ordered_order_count', 'rejected_order_count', 'arrived_order_count')
+
     # The default string output for a book as "<title> (<author>) [ISBN: <isbn>)"
     def __str__(self):
         try:
@@ -129,7 +208,226 @@ class Book(models.Model):
         ordering = ['title']
 
 
-class OrderManager(models.Manager):
+@receiver(post_save, sender=Book)
+def index_book(sender, instance, raw=False, **kwargs):
+    """
+        Update the search index of a book whenever it is saved.
+    """
+    if not raw:
+        BookSearchToken.objects.index(instance)
+
+
+class SearchTokenManager(models.Manager):
+
+    """
+        The base manager for the search indexes, which map objects to the
+        (field, token) pairs returned by `get_tokens`. The token model refers
+        to the indexed object by its `target` field.
+    """
+
+    # The name of the foreign key to the indexed object
+    target = None
+
+    # The indexed fields by the names of the search form fields
+    search_fields = ()
+
+    def get_tokens(self, obj):
+        """
+            Get the set of (field, token) pairs to index for the object. Each
+            index implements this in its own manager.
+        """
+        raise NotImplementedError('%s must implement get_tokens()' % type(self).__name__)
+
+    def prefixed(self, tokens, prefix):
+        """
+            Filter the tokens by their prefix, as a range so the (field, token)
+            index can be used.
+        """
+        end = search.prefix_end(prefix)
+        tokens = tokens.filter(token__gte=prefix)
+        return tokens.filter(token__lt=end) if end else tokens
+
+    def index(self, obj):
+        """
+            Replace the indexed tokens of the object.
+        """
+        tokens = self.get_tokens(obj)
+        existing = set(self.filter(**{self.target: obj}).values_list('field', 'token'))
+        if tokens == existing:
+            return
+        self.filter(**{self.target: obj}).delete()
+        self.bulk_create(
+            self.model(field=field, token=token, **{self.target: obj}) for field, token in tokens
+        )
+
+    def rebuild(self, queryset):
+        """
+            Replace the whole index with the tokens of the objects in the
+            queryset. Returns the number of tokens indexed.
+        """
+        self.all().delete()
+        tokens = [
+            self.model(field=field, token=token, **{self.target: obj})
+            for obj in queryset.iterator()
+            for field, token in self.get_tokens(obj)
+        ]
+        # Insert in batches the database can take, SQLite allows only a few
+        # hundred rows per statement
+        fields = [self.model._meta.get_field(name) for name in ('field', 'token', self.target)]
+        batch_size = min(1000, connections[self.db].ops.bulk_batch_size(fields, tokens))
+        self.bulk_create(tokens, batch_size=batch_size)
+        return len(tokens)
+
+    def search(self, queryset, data):
+        """
+            Filter the queryset by the cleaned data of a search form.
+            Every word entered has to match the start of a word in the field
+            it was entered in. Objects with more whole word matches come first.
+            If nothing is found, misspelled words are replaced by the most
+            similar indexed word.
+        """
+        words = []
+        for name, field in self.search_fields:
+            words += [(field, token) for token in search.query_tokens(field, data.get(name))]
+        if not words:
+            return queryset
+
+        result = self.search_words(queryset, words)
+        if not result.exists():
+            corrected = [(field, self.correct(field, token)) for field, token in words]
+            if corrected != words:
+                result = self.search_words(queryset, corrected)
+        return result
+
+    def search_words(self, queryset, words):
+        # The subqueries are not correlated with the searched objects, so each
+        # of them is a single range scan of the (field, token) index
+        rank = None
+        for field, token in words:
+            tokens = self.filter(field=field)
+            matches = self.prefixed(tokens, token).values(self.target)
+            exact = tokens.filter(token=token).values(self.target)
+            queryset = queryset.filter(pk__in=matches)
+            score = Case(When(pk__in=exact, then=Value(2)), default=Value(1), output_field=models.IntegerField())
+            rank = score if rank is None else rank + score
+        return queryset.annotate(search_rank=rank).order_by('-search_rank', *queryset.model._meta.ordering)
+
+    def correct(self, field, token):
+        """
+            Get the indexed token of the field most similar to the given one,
+            if the given token does not start any indexed token.
+        """
+        if field in search.LITERAL_FIELDS or len(token) < 4:
+            return token
+        tokens = self.filter(field=field)
+        if self.prefixed(tokens, token).exists():
+            return token
+        candidates = self.prefixed(tokens, token[0]) \
+            .values_list('token', flat=True) \
+            .distinct()
+        matches = difflib.get_close_matches(token, candidates, 1, 0.75)
+        return matches[0] if matches else token
+
+
+class BookSearchTokenManager(SearchTokenManager):
+
+    target = 'book'
+    search_fields = search.BOOK_SEARCH_FIELDS
+
+    def get_tokens(self, book):
+        return search.book_tokens(book)
+
+
+class BookSearchToken(models.Model):
+
+    """
+        A folded word of a book's title, author or publisher, or its ISBN.
+        Together these form an inverted index used to search for books.
+    """
+
+    objects = BookSearchTokenManager()
+
+    # The possible fields of a book a token is taken from
+    FIELD_CHOICES = (
+        (search.TITLE, _('title')),
+        (search.AUTHOR, _('author')),
+        (search.PUBLISHER, _('publisher')),
+        (search.ISBN, "ISBN"),
+    )
+
+    # The book this token belongs to
+    book = models.ForeignKey(
+        'Book',
+        on_delete=models.CASCADE,
+        related_name='search_tokens',
+        verbose_name=_("book"),
+    )
+
+    # The field of the book this token is taken from
+    field = models.CharField(
+        max_length=1,
+        choices=FIELD_CHOICES,
+        verbose_name=_("field"),
+    )
+
+    # The folded word
+    token = models.CharField(
+        max_length=search.TOKEN_LENGTH,
+        verbose_name=_("token"),
+    )
+
+    def __str__(self):
+        return self.token
+
+    class Meta:
+        index_together = ('field', 'token')
+        verbose_name = _("search token")
+        verbose_name_plural = _("search tokens")
+
+
+class OrderManager(models.Manager.from_queryset(CountedQuerySet)):
+
+    # The related objects that are displayed with every listed order
+    listing_related = ('book', 'student__tuid_user', 'order_timeframe')
+
+    def listing(self):
+        """
+            The orders with everything needed to list them joined into the
+            same query, used by the account page, the order list and the admin.
+        """
+        return self.select_related(*self.listing_related)
+
+    def place(self, student, book, **kwargs):
+        """
+            Places a pending order of the book for the student in the current
+            timeframe. The student row is locked while the budget is checked and
+            the order is created, so concurrent orders of the same student can
+            never exceed the budget. Raises a ValidationError if there is no
+            current timeframe or no budget left.
+        """
+        date = to_date()
+        timeframe = OrderTimeframe.objects.current(date)
+        if not timeframe:
+            raise ValidationError(_("Book ordering is not active for the current date"), code='no_timeframe')
+
+        with transaction.atomic():
+            # Lock the student until the order is created
+            Student.objects.select_for_update().get(pk=student.pk)
+            budget_max = OrderTimeframe.objects.semester_budget(timeframe.semester, date)
+            budget_spent = self.student_semester_order_count(student, timeframe.semester, date)
+            if budget_max - budget_spent <= 0:
+                raise ValidationError(_("You may not order any more books in this timeframe."), code='no_budget_left')
+            order = self.create(
+                book=book,
+                student=student,
+                order_timeframe=timeframe,
+                status=kwargs.pop('status', Order.PENDING),
+                **kwargs
+            )
+
+        # The memoized budget of the student is outdated now
+        student.__dict__.pop('_budget', None)
+        return order
 
     def student_semester_orders(self, student, semester, date=datetime.now()):
         return student.order_set \
@@ -244,7 +542,7 @@ class StudentManager(models.Manager):
         return self.filter(tuid_user=tuid_user).first()
 
 
-class Student(models.Model):
+class Student(CountedModel):
 
     """
         A student participating in the Buchaktion. A student is someone that
@@ -296,6 +594,11 @@ class Student(models.Model):
         blank=True,
     )
 
+    # The number of orders of this student, kept up to date by the order signals
+    order_count = models.PositiveIntegerField(default=0, editable=False, verbose_name=_("orders"))
+
+    counter_fields = ('order_count',)
+
     # Get the default string representation as "#<id>"
     def __str__(self):
         return "{0} ({1})".format(self.tuid_user.name(), self.tuid_user.uid)
@@ -304,6 +607,13 @@ class Student(models.Model):
     def natural_key(self):
         return {"id": self.id}
 
+    # Get the budget for the current or upcoming timeframe. This is computed
+    # once per instance, which usually lives for a single request.
+    def budget(self):
+        if not hasattr(self, '_budget'):
+            self._budget = OrderTimeframe.objects.student_budget(self)
+        return self._budget
+
     # Set the singular and plural names for i18n
     class Meta:
         verbose_name = _("student")
@@ -321,33 +631,107 @@ def save_student(sender, **kwargs):
         kwargs['instance'].library_id = None
 
 
-class OrderTimeframeManager(models.Manager):
+def to_date(date=None):
+    """
+        Gets the date for the given date or datetime, defaulting to today.
+    """
+    if not date:
+        date = datetime.now()
+    if isinstance(date, datetime):
+        date = date.date()
+    return date
+
+
+class StudentBudget(object):
+
+    """
+        The budget of a student for the semester of a timeframe, i.e.
+        the number of orders allowed and posted so far in that semester.
+    """
+
+    def __init__(self, timeframe, allowed, spent, date):
+        self.timeframe = timeframe
+        self.allowed = allowed
+        self.spent = spent
+        self.is_current = timeframe is not None and timeframe.start_date <= date
+
+    # The timeframe if it is currently open for orders
+    @property
+    def current_timeframe(self):
+        return self.timeframe if self.is_current else None
+
+    @property
+    def left(self):
+        return self.allowed - self.spent
+
+
+# The cached timeframes as (load time, end dates, timeframes), sorted by end date
+_timeframe_cache = None
+
+
+class OrderTimeframeManager(models.Manager.from_queryset(CountedQuerySet)):
+
+    def cached(self):
+        """
+            Gets all timeframes with their semesters sorted by end date, along
+            with the list of their end dates for binary search. They are loaded
+            once and kept in memory until a timeframe or semester is changed,
+            or BUCHAKTION_TIMEFRAME_CACHE_TIMEOUT seconds have passed.
+        """
+        global _timeframe_cache
+        now = time.monotonic()
+        if _timeframe_cache is None or (
+                BUCHAKTION_TIMEFRAME_CACHE_TIMEOUT is not None
+                and now - _timeframe_cache[0] > BUCHAKTION_TIMEFRAME_CACHE_TIMEOUT):
+            timeframes = list(OrderTimeframe.objects.select_related('semester').order_by('end_date', 'pk'))
+            _timeframe_cache = (now, [timeframe.end_date for timeframe in timeframes], timeframes)
+        return _timeframe_cache[1:]
+
+    def _copy(self, timeframe):
+        """
+            Copy a cached timeframe along with its semester, as the cached
+            instances are shared between all threads and must not be changed
+            by the callers.
+        """
+        return copy.deepcopy(timeframe)
+
+    def student_budget(self, student, date=None):
+        """
+            Gets the budget of the student for the current timeframe, or the
+            upcoming one if there is no current timeframe. Only the orders of
+            the student are counted in the database.
+        """
+        date = to_date(date)
+        timeframe = self.current(date) or self.upcoming(date)
+        if not timeframe:
+            return StudentBudget(None, 0, 0, date)
+        allowed = self.semester_budget(timeframe.semester, date)
+        spent = Order.objects.student_semester_order_count(student, timeframe.semester, date)
+        return StudentBudget(timeframe, allowed, spent, date)
 
     def semester_budget(self, semester, date=None):
-        if not date:
-            date = datetime.now()
-        return semester.ordertimeframe_set \
-            .filter(start_date__lte=date) \
-            .aggregate(Sum('allowed_orders'))['allowed_orders__sum']
+        date = to_date(date)
+        ends, timeframes = self.cached()
+        return sum(
+            timeframe.allowed_orders for timeframe in timeframes
+            if timeframe.semester_id == semester.pk and timeframe.start_date <= date
+        )
 
     def current(self, date=None):
-        if not date:
-            date = datetime.now()
-        try:
-            return self \
-                .filter(start_date__lte=date) \
-                .filter(end_date__gte=date) \
-                .earliest('end_date')
-        except OrderTimeframe.DoesNotExist as e:
-            return None
+        date = to_date(date)
+        ends, timeframes = self.cached()
+        for timeframe in timeframes[bisect_left(ends, date):]:
+            if timeframe.start_date <= date:
+                return self._copy(timeframe)
+        return None
 
     def upcoming(self, date=None):
-        if not date:
-            date = datetime.now()
-        try:
-            return self.filter(start_date__gt=date).earliest('end_date')
-        except OrderTimeframe.DoesNotExist as e:
-            return None
+        date = to_date(date)
+        ends, timeframes = self.cached()
+        for timeframe in timeframes[bisect_left(ends, date):]:
+            if timeframe.start_date > date:
+                return self._copy(timeframe)
+        return None
 
 
 class OrderTimeframe(models.Model):
@@ -419,6 +803,9 @@ class Semester(models.Model):
         the one in which the semester starts, so it is W16 for winter semester 2016/2017.
     """
 
+    # Deleting semesters in bulk cascades to their modules and timeframes
+    objects = CountedQuerySet.as_manager()
+
     # The winter term season key
     WISE='W'
     # The summer term season key
@@ -472,7 +859,27 @@ class Semester(models.Model):
         verbose_name = _("semester")
         verbose_name_plural = _("semesters")
 
-class Module(models.Model):
+
+@receiver(post_save, sender=OrderTimeframe)
+@receiver(post_delete, sender=OrderTimeframe)
+@receiver(post_save, sender=Semester)
+@receiver(post_delete, sender=Semester)
+def invalidate_timeframes(sender, **kwargs):
+    """
+        Drop the cached timeframes whenever a timeframe or semester changes,
+        and again once the change is committed, in case another thread has
+        loaded the old rows in the meantime.
+    """
+    drop_timeframes()
+    transaction.on_commit(drop_timeframes)
+
+
+def drop_timeframes():
+    global _timeframe_cache
+    _timeframe_cache = None
+
+
+class Module(CountedModel):
 
     """
         A module (e.g. readings, exercise groups, ...) that porvides literature
@@ -483,6 +890,8 @@ class Module(models.Model):
         The name TUCaN refers to the TU Darmstadt CampusNet management system.
     """
 
+    objects = CountedQuerySet.as_manager()
+
     # The custom id for a module
     module_id = models.CharField(max_length=13, unique=True, verbose_name=_("module id"))
 
@@ -501,6 +910,11 @@ class Module(models.Model):
     # The category that this module will appear in
     category = models.ForeignKey('ModuleCategory', on_delete=models.SET_NULL, null=True, blank=True, verbose_name=_('category'))
 
+    # The number of literature entries, kept up to date by the literature signals
+    literature_count = models.PositiveIntegerField(default=0, editable=False, verbose_name=_("literature count"))
+
+    counter_fields = ('literature_count',)
+
     # Get the default string representation as "<name> [<module_id>]"
     def __str__(self):
         return '%(name)s [%(module_id)s]' % {'name': self.name, 'module_id': self.module_id}
@@ -520,7 +934,39 @@ class Module(models.Model):
         ordering = ['module_id']
 
 
+class LiteratureManager(models.Manager.from_queryset(CountedQuerySet)):
+
+    def module_books(self, module, student=None):
+        """
+            Load the accepted books of a module, split into the literature of
+            the module and the recommendations by students. If a student is
+            given, the orders of the student are attached to each book as
+            orderset. This takes at most two queries.
+        """
+        literature_infos = self.filter(module=module, book__state=Book.ACCEPTED) \
+            .select_related('book') \
+            .order_by('book__title')
+        books = {}
+        literature = []
+        recommendations = []
+        for literature_info in literature_infos:
+            book = literature_info.book
+            book.orderset = []
+            books[book.pk] = book
+            if literature_info.source == Literature.STUDENT:
+                recommendations.append(book)
+            else:
+                literature.append(book)
+        if student and books:
+            for order in Order.objects.filter(student=student, book__in=list(books)):
+                books[order.book_id].orderset.append(order)
+        return literature, recommendations
+
+
 class Literature(models.Model):
+
+    objects = LiteratureManager()
+
     module = models.ForeignKey(Module, on_delete=models.CASCADE, related_name='literature_info', verbose_name=_('module'))
     book = models.ForeignKey(Book, on_delete=models.CASCADE, related_name='literature_info', verbose_name=_('book'))
 
@@ -559,7 +1005,81 @@ class Literature(models.Model):
         verbose_name_plural = _("literature")
 
 
-class ModuleCategory(models.Model):
+@receiver(post_save, sender=Literature)
+@receiver(post_delete, sender=Literature)
+def count_literature(sender, instance, raw=False, **kwargs):
+    """
+        Update the literature count of the module whenever its literature
+        changes. Bulk changes have to refresh the count themselves.
+    """
+    if not raw:
+        queue_counters(Module, [instance.module_id])
+
+
+@receiver(post_save, sender=Module)
+def index_module(sender, instance, raw=False, **kwargs):
+    """
+        Update the search index of a module whenever it is saved.
+    """
+    if not raw:
+        ModuleSearchToken.objects.index(instance)
+
+
+class ModuleSearchTokenManager(SearchTokenManager):
+
+    target = 'module'
+    search_fields = search.MODULE_SEARCH_FIELDS
+
+    def get_tokens(self, module):
+        return search.module_tokens(module)
+
+
+class ModuleSearchToken(models.Model):
+
+    """
+        A folded word of one of a module's names, or its module id. Together
+        these form an inverted index used to search for modules.
+    """
+
+    objects = ModuleSearchTokenManager()
+
+    # The possible fields of a module a token is taken from
+    FIELD_CHOICES = (
+        (search.NAME, _('name')),
+        (search.MODULE_ID, _('module id')),
+    )
+
+    # The module this token belongs to
+    module = models.ForeignKey(
+        'Module',
+        on_delete=models.CASCADE,
+        related_name='search_tokens',
+        verbose_name=_("module"),
+    )
+
+    # The field of the module this token is taken from
+    field = models.CharField(
+        max_length=1,
+        choices=FIELD_CHOICES,
+        verbose_name=_("field"),
+    )
+
+    # The folded word
+    token = models.CharField(
+        max_length=search.TOKEN_LENGTH,
+        verbose_name=_("token"),
+    )
+
+    def __str__(self):
+        return self.token
+
+    class Meta:
+        index_together = ('field', 'token')
+        verbose_name = _("search token")
+        verbose_name_plural = _("search tokens")
+
+
+class ModuleCategory(CountedModel):
 
     # The name for this category
     name_de = models.CharField(max_length = 128, verbose_name = _("german name"))
@@ -570,6 +1090,11 @@ class ModuleCategory(models.Model):
     # Whether the category should be visible
     visible = models.BooleanField(default=True, verbose_name = _("visible"))
 
+    # The number of modules in this category, kept up to date by the module signals
+    module_count = models.PositiveIntegerField(default=0, editable=False, verbose_name = _("module count"))
+
+    counter_fields = ('module_count',)
+
     # Get the displayed name: english if given and active, else german
     def name(self):
         return self.name_en if get_language() == 'en' and self.name_en else self.name_de
@@ -582,6 +1107,188 @@ class ModuleCategory(models.Model):
         verbose_name_plural = _("module categories")
 
 
+def get_counters():
+    """
+        The maintained counter columns as tuples of the model holding the
+        counter, the name of the counter field, the queryset of the counted
+        rows and the lookup from a counted row to the model.
+    """
+    orders = Order.objects.all()
+    return [
+        (Book, 'order_count', orders, 'book'),
+        (Book, 'pending_order_count', orders.filter(status=Order.PENDING), 'book'),
+        (Book, 'ordered_order_count', orders.filter(status=Order.ORDERED), 'book'),
+        (Book, 'rejected_order_count', orders.filter(status=Order.REJECTED), 'book'),
+        (Book, 'arrived_order_count', orders.filter(status=Order.ARRIVED), 'book'),
+        (Student, 'order_count', orders, 'student'),
+        (Module, 'literature_count', Literature.objects.all(), 'module'),
+        (ModuleCategory, 'module_count', Module.objects.all(), 'category'),
+    ]
+
+
+def counter_value(counted, lookup):
+    """
+        An expression for the actual value of a counter, counting the rows
+        of the counted queryset that refer to the outer row.
+    """
+    count = counted \
+        .filter(**{lookup: OuterRef('pk')}) \
+        .order_by() \
+        .values(lookup) \
+        .annotate(count=Count('pk')) \
+        .values('count')
+    return Coalesce(Subquery(count, output_field=models.IntegerField()), 0)
+
+
+def refresh_counters(model, pks=None):
+    """
+        Recount all counters of the given model for the rows with the given
+        primary keys, or for all rows, in a single query. Bulk changes that
+        bypass the signals have to call this themselves.
+    """
+    values = {
+        field: counter_value(counted, lookup)
+        for counter_model, field, counted, lookup in get_counters()
+        if counter_model is model
+    }
+    queryset = model.objects.all()
+    if pks is not None:
+        pks = [pk for pk in pks if pk is not None]
+        if not pks:
+            return 0
+        queryset = queryset.filter(pk__in=pks)
+    count = queryset.update(**values)
+    if model in (Module, ModuleCategory):
+        invalidate_module_listing()
+    return count
+
+
+# The counters to refresh once the current bulk deletion is done, per thread
+_deferred_counters = threading.local()
+
+
+@contextmanager
+def deferred_counters():
+    """
+        Collect the counters changed by the signals within the block and
+        refresh each model once at its end, instead of once per row.
+    """
+    if getattr(_deferred_counters, 'pks', None) is not None:
+        yield
+        return
+    _deferred_counters.pks = defaultdict(set)
+    try:
+        yield
+        pending = _deferred_counters.pks
+    finally:
+        _deferred_counters.pks = None
+    for model, pks in pending.items():
+        refresh_counters(model, pks)
+
+
+def queue_counters(model, pks):
+    """
+        Refresh the counters of the given rows, or remember them if a bulk
+        deletion is in progress.
+    """
+    pending = getattr(_deferred_counters, 'pks', None)
+    if pending is None:
+        refresh_counters(model, pks)
+    else:
+        pending[model].update(pks)
+
+
+# The cache key of the current generation of the module listing
+MODULE_LISTING_GENERATION_KEY = 'pyBuchaktion:module_listing_generation'
+
+
+def module_listing_generation():
+    """
+        Get the current generation of the module listing, which is part of
+        the key of its cached fragments and changes whenever a module, a
+        category or their literature changes.
+    """
+    cache = caches[BUCHAKTION_MODULES_CACHE]
+    generation = cache.get(MODULE_LISTING_GENERATION_KEY)
+    if generation is None:
+        cache.add(MODULE_LISTING_GENERATION_KEY, uuid.uuid4().hex, None)
+        generation = cache.get(MODULE_LISTING_GENERATION_KEY)
+    return generation
+
+
+@receiver(post_save, sender=ModuleCategory)
+@receiver(post_delete, sender=ModuleCategory)
+@receiver(post_save, sender=Module)
+@receiver(post_delete, sender=Module)
+@receiver(post_save, sender=Literature)
+@receiver(post_delete, sender=Literature)
+def invalidate_module_listing(**kwargs):
+    """
+        Start a new generation of the module listing once the change is
+        committed, so the cached fragments of the previous one are no longer
+        used. Starting it earlier would let a concurrent request cache the
+        old listing under the new generation.
+    """
+    transaction.on_commit(lambda: caches[BUCHAKTION_MODULES_CACHE].set(
+        MODULE_LISTING_GENERATION_KEY, uuid.uuid4().hex, None))
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_save, sender=Student)
+@receiver(post_save, sender=Module)
+@receiver(post_save, sender=ModuleCategory)
+def restore_counters(sender, instance, created, raw=False, update_fields=None, **kwargs):
+    """
+        A save that explicitly writes counters may write outdated ones, so
+        they are recounted afterwards. Full saves leave the counters out, see
+        CountedModel.
+    """
+    if not (created or raw) and update_fields and set(update_fields) & set(sender.counter_fields):
+        refresh_counters(sender, [instance.pk])
+
+
+@receiver(post_init, sender=Order)
+def remember_order_references(sender, instance, **kwargs):
+    """
+        Remember the book and student an order was loaded with, so their
+        counters can be corrected as well when the order is moved.
+    """
+    instance._counted_references = (instance.__dict__.get('book_id'), instance.__dict__.get('student_id'))
+
+
+@receiver(post_save, sender=Order)
+@receiver(post_delete, sender=Order)
+def count_orders(sender, instance, raw=False, **kwargs):
+    """
+        Update the order counters of the book and student of an order
+        whenever it is saved or deleted.
+    """
+    if raw:
+        return
+    book_id, student_id = instance._counted_references
+    queue_counters(Book, {book_id, instance.book_id})
+    queue_counters(Student, {student_id, instance.student_id})
+    instance._counted_references = (instance.book_id, instance.student_id)
+
+
+@receiver(post_init, sender=Module)
+def remember_module_category(sender, instance, **kwargs):
+    instance._counted_category = instance.__dict__.get('category_id')
+
+
+@receiver(post_save, sender=Module)
+@receiver(post_delete, sender=Module)
+def count_modules(sender, instance, raw=False, **kwargs):
+    """
+        Update the module counters of the old and new category of a module
+        whenever it is saved or deleted.
+    """
+    if raw:
+        return
+    queue_counters(ModuleCategory, {instance._counted_category, instance.category_id})
+    instance._counted_category = instance.category_id
+
+
 class DisplayMessage(models.Model):
 
     # The key used to display this message
@@ -602,3 +1309,177 @@ class DisplayMessage(models.Model):
     class Meta:
         verbose_name = _("display message")
         verbose_name_plural = _("display messages")
+
+
+class OutboxMessageManager(models.Manager):
+
+    def enqueue(self, emails):
+        """
+            Put the given email messages into the outbox.
+        """
+        return self.bulk_create([
+            OutboxMessage(
+                subject=email.subject,
+                body=email.body,
+                from_email=email.from_email,
+                to="\n".join(email.to),
+                reply_to="\n".join(email.reply_to),
+            ) for email in emails
+        ])
+
+    def due(self):
+        """
+            The pending messages that should be sent now, oldest first.
+        """
+        return self.filter(
+            state=OutboxMessage.PENDING,
+            next_attempt__lte=timezone.now(),
+        ).order_by('next_attempt', 'pk')
+
+    def claim(self, batch_size):
+        """
+            Reserve the next due messages for the calling worker and return
+            them. The claim is a conditional update, so of several workers
+            only one gets each message. Claimed messages are not due again
+            for BUCHAKTION_MAIL_CLAIM_TIMEOUT seconds, so the messages of a
+            worker that died while sending are picked up after that.
+        """
+        now = timezone.now()
+        token = uuid.uuid4().hex
+        pks = list(self.due().values_list('pk', flat=True)[:batch_size])
+        self.filter(pk__in=pks, state=OutboxMessage.PENDING, next_attempt__lte=now).update(
+            claim=token,
+            next_attempt=now + timedelta(seconds=BUCHAKTION_MAIL_CLAIM_TIMEOUT),
+        )
+        return list(self.filter(claim=token).order_by('pk'))
+
+
+class OutboxMessage(models.Model):
+
+    """
+        An email waiting in the outbox. Failed deliveries are retried with an
+        exponentially growing delay until the maximum number of attempts
+        has been reached.
+    """
+
+    objects = OutboxMessageManager()
+
+    # Pending: The message waits to be sent
+    PENDING='PD'
+    # Sent: The message has been handed to the mail server
+    SENT='ST'
+    # Failed: The message could not be delivered in any attempt
+    FAILED='FL'
+
+    # The possible delivery states for a message
+    STATE_CHOICES = (
+        (PENDING, _('Pending')),
+        (SENT, _('Sent')),
+        (FAILED, _('Failed')),
+    )
+
+    # The subject line of the message
+    subject = models.TextField(
+        verbose_name=_("subject"),
+    )
+
+    # The message text
+    body = models.TextField(
+        verbose_name=_("body"),
+    )
+
+    # The sender address, as it was when the message was queued
+    from_email = models.CharField(
+        max_length=255,
+        verbose_name=_("sender"),
+        blank=True,
+    )
+
+    # The recipient addresses, one per line
+    to = models.TextField(
+        verbose_name=_("recipients"),
+    )
+
+    # The reply-to addresses, one per line
+    reply_to = models.TextField(
+        verbose_name=_("reply to"),
+        blank=True,
+    )
+
+    # The delivery state of the message
+    state = models.CharField(
+        max_length=2,
+        choices=STATE_CHOICES,
+        default=PENDING,
+        verbose_name=_("state"),
+    )
+
+    # The number of failed delivery attempts
+    attempts = models.PositiveIntegerField(
+        default=0,
+        verbose_name=_("attempts"),
+    )
+
+    # The earliest time for the next delivery attempt
+    next_attempt = models.DateTimeField(
+        default=timezone.now,
+        verbose_name=_("next attempt"),
+    )
+
+    # The error of the last failed delivery attempt
+    last_error = models.TextField(
+        verbose_name=_("last error"),
+        blank=True,
+    )
+
+    # The worker that currently sends the message, see claim()
+    claim = models.CharField(
+        max_length=32,
+        blank=True,
+        editable=False,
+    )
+
+    # The time the message was put into the outbox
+    created = models.DateTimeField(
+        auto_now_add=True,
+        verbose_name=_("created"),
+    )
+
+    # The time the message has been sent
+    sent = models.DateTimeField(
+        null=True,
+        blank=True,
+        verbose_name=_("sent"),
+    )
+
+    def email_message(self, connection=None):
+        return EmailMessage(
+            subject=self.subject,
+            body=self.body,
+            from_email=self.from_email or None,
+            to=self.to.splitlines(),
+            reply_to=self.reply_to.splitlines(),
+            connection=connection,
+        )
+
+    def delivered(self):
+        self.state = OutboxMessage.SENT
+        self.sent = timezone.now()
+        self.save(update_fields=['state', 'sent'])
+
+    def failed(self, error):
+        self.attempts += 1
+        self.last_error = str(error)
+        if self.attempts >= BUCHAKTION_MAIL_MAX_ATTEMPTS:
+            self.state = OutboxMessage.FAILED
+        else:
+            delay = BUCHAKTION_MAIL_RETRY_DELAY * 2 ** (self.attempts - 1)
+            self.next_attempt = timezone.now() + timedelta(seconds=delay)
+        self.save(update_fields=['attempts', 'last_error', 'state', 'next_attempt'])
+
+    def __str__(self):
+        return self.subject
+
+    class Meta:
+        verbose_name = _("outbox message")
+        verbose_name_plural = _("outbox messages")
@@ -0,0 +1,137 @@
+import json
+import base64
+import binascii
+
+from django.core.paginator import InvalidPage
+from django.db.models import F, Q
+from django.db.models.expressions import OrderBy
+from django.utils.translation import ugettext_lazy as _
+
+
+def get_ordering(queryset):
+    """
+        The ordering of the queryset as a list of (name, descending) pairs,
+        made unique by ordering by the primary key last. Only orderings by
+        fields can be followed by a cursor, others raise a ValueError.
+    """
+    ordering = []
+    for name in queryset.query.order_by or queryset.model._meta.ordering:
+        if isinstance(name, OrderBy) and isinstance(name.expression, F):
+            ordering.append((name.expression.name, name.descending))
+        elif isinstance(name, str) and name != '?':
+            ordering.append((name.lstrip('-'), name.startswith('-')))
+        else:
+            raise ValueError("Cannot paginate by a cursor on the ordering %r, only fields are supported" % (name,))
+    if not any(name in ('pk', queryset.model._meta.pk.name) for name, descending in ordering):
+        ordering.append(('pk', False))
+    return ordering
+
+
+def get_value(obj, name):
+    for part in name.split('__'):
+        obj = getattr(obj, part)
+    return obj
+
+
+def encode_cursor(values):
+    data = json.dumps(values, default=str).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, length):
+    try:
+        data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(data.decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise InvalidPage(_("Invalid cursor"))
+    if not isinstance(values, list) or len(values) != length:
+        raise InvalidPage(_("Invalid cursor"))
+    return values
+
+
+class CursorPage(object):
+
+    """
+        A page of a cursor paginated list. Instead of page numbers, the links
+        to the neighbouring pages carry the ordering values of the first or
+        last object of this page.
+    """
+
+    def __init__(self, object_list, ordering, has_previous, has_next):
+        self.object_list = object_list
+        self.ordering = ordering
+        self._has_previous = has_previous
+        self._has_next = has_next
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_next(self):
+        return self._has_next
+
+    def has_other_pages(self):
+        return self._has_previous or self._has_next
+
+    def cursor(self, obj):
+        return encode_cursor([get_value(obj, name) for name, descending in self.ordering])
+
+    # The query parameters of the link to the previous page
+    def previous_page_params(self):
+        return {'before': self.cursor(self.object_list[0])}
+
+    # The query parameters of the link to the next page
+    def next_page_params(self):
+        return {'after': self.cursor(self.object_list[-1])}
+
+
+class CursorPaginator(object):
+
+    """
+        Paginates a queryset by filtering on the values of its ordering
+        after or before a cursor. Every page takes a single query, without
+        counting the rows or skipping over the previous pages.
+    """
+
+    def __init__(self, queryset, per_page):
+        self.ordering = get_ordering(queryset)
+        self.queryset = queryset
+        self.per_page = per_page
+
+    def order_by(self, reverse):
+        return ['-' + name if descending != reverse else name for name, descending in self.ordering]
+
+    def filter(self, values, reverse):
+        """
+            Get the condition for the rows following the given ordering
+            values, or preceding them if reverse is set.
+        """
+        condition = Q()
+        equal = Q()
+        for (name, descending), value in zip(self.ordering, values):
+            lookup = 'lt' if descending != reverse else 'gt'
+            condition |= equal & Q(**{name + '__' + lookup: value})
+            equal &= Q(**{name: value})
+        return condition
+
+    def page(self, after=None, before=None):
+        if before:
+            values = decode_cursor(before, len(self.ordering))
+            queryset = self.queryset.filter(self.filter(values, True)).order_by(*self.order_by(True))
+            object_list = list(queryset[:self.per_page + 1])
+            has_previous = len(object_list) > self.per_page
+            object_list = object_list[:self.per_page][::-1]
+            return CursorPage(object_list, self.ordering, has_previous, bool(object_list))
+
+        queryset = self.queryset.order_by(*self.order_by(False))
+        if after:
+            values = decode_cursor(after, len(self.ordering))
+            queryset = queryset.filter(self.filter(values, False))
+        object_list = list(queryset[:self.per_page + 1])
+        has_next = len(object_list) > self.per_page
+        return CursorPage(object_list[:self.per_page], self.ordering, bool(after and object_list), has_next)
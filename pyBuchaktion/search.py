@@ -0,0 +1,128 @@
+"""
+    Text processing for the book and module search indexes. Names, titles,
+    authors and publishers are split into folded tokens, i.e. lower case
+    words without accents, while ISBNs and module ids are indexed as a single
+    normalized token. The indexes themselves are stored in the
+    BookSearchToken and ModuleSearchToken models.
+"""
+
+import re
+import sys
+import unicodedata
+import isbnlib
+
+# The codes of the indexed book fields
+TITLE = 'T'
+AUTHOR = 'A'
+PUBLISHER = 'P'
+ISBN = 'I'
+
+# The codes of the indexed module fields
+NAME = 'N'
+MODULE_ID = 'M'
+
+# The indexed book fields by the names of the BookSearchForm fields
+BOOK_SEARCH_FIELDS = (
+    ('title', TITLE),
+    ('author', AUTHOR),
+    ('publisher', PUBLISHER),
+    ('isbn_13', ISBN),
+)
+
+# The indexed module fields by the names of the ModuleSearchForm fields
+MODULE_SEARCH_FIELDS = (
+    ('name', NAME),
+    ('module_id', MODULE_ID),
+)
+
+# The fields indexed as a single token, which are searched literally
+LITERAL_FIELDS = (ISBN, MODULE_ID)
+
+# The maximum length of an indexed token
+TOKEN_LENGTH = 64
+
+WORD_REGEX = re.compile(r'\w+')
+ISBN_REGEX = re.compile(r'[^0-9X]')
+MODULE_ID_REGEX = re.compile(r'\W|_')
+
+
+def fold(text):
+    """
+    Lower cases the text and strips all accents, so that e.g. "Größe"
+    and "grosse" are the same.
+    """
+    text = unicodedata.normalize('NFKD', text.casefold())
+    return ''.join(char for char in text if not unicodedata.combining(char))
+
+
+def tokenize(text):
+    return [word[:TOKEN_LENGTH] for word in WORD_REGEX.findall(fold(text or ""))]
+
+
+def normalize_isbn(text):
+    return ISBN_REGEX.sub("", (text or "").upper())
+
+
+def normalize_module_id(text):
+    return MODULE_ID_REGEX.sub("", fold(text or ""))[:TOKEN_LENGTH]
+
+
+def prefix_end(prefix):
+    """
+    Gets the smallest string that sorts after every string starting with
+    the prefix, so that a prefix search can be a range scan of the index.
+    Returns None if there is no such string.
+    """
+    prefix = prefix.rstrip(chr(sys.maxunicode))
+    if not prefix:
+        return None
+    end = ord(prefix[-1]) + 1
+    # Surrogates can not be stored, the next character is the one after them
+    if 0xD800 <= end < 0xE000:
+        end = 0xE000
+    return prefix[:-1] + chr(end)
+
+
+def query_tokens(field, text):
+    """
+    Gets the tokens to search for in a field. ISBNs and module ids are
+    searched as a single token, so that their prefix can be entered with or
+    without dashes.
+    """
+    if field == ISBN:
+        token = normalize_isbn(text)
+    elif field == MODULE_ID:
+        token = normalize_module_id(text)
+    else:
+        return tokenize(text)
+    return [token] if token else []
+
+
+def book_tokens(book):
+    """
+    Gets the set of (field, token) pairs to index for a book. Besides the
+    ISBN-13, the ISBN-10 is indexed if the book has one.
+    """
+    tokens = set()
+    for field, text in ((TITLE, book.title), (AUTHOR, book.author), (PUBLISHER, book.publisher)):
+        tokens.update((field, token) for token in tokenize(text))
+    isbn = normalize_isbn(book.isbn_13)
+    if isbn:
+        tokens.add((ISBN, isbn))
+        isbn_10 = isbnlib.to_isbn10(isbn) if isbnlib.is_isbn13(isbn) else None
+        if isbn_10:
+            tokens.add((ISBN, isbn_10))
+    return tokens
+
+
+def module_tokens(module):
+    """
+    Gets the set of (field, token) pairs to index for a module. Both the
+    german and the english name are indexed, so modules can be found by
+    either name regardless of the current language.
+    """
+    tokens = set((NAME, token) for token in tokenize(module.name_de) + tokenize(module.name_en))
+    module_id = normalize_module_id(module.module_id)
+    if module_id:
+        tokens.add((MODULE_ID, module_id))
+    return tokens
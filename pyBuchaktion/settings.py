@@ -2,3 +2,12 @@ from django.conf import settings
 
 BUCHAKTION_STUDENT_LDAP_GROUP = getattr(settings, 'BUCHAKTION_STUDENT_LDAP_GROUP', "FB20")
 BUCHAKTION_MESSAGES_DEBUG = getattr(settings, 'BUCHAKTION_MESSAGES_DEBUG', True)
+BUCHAKTION_MESSAGES_CACHE = getattr(settings, 'BUCHAKTION_MESSAGES_CACHE', None)
+BUCHAKTION_MESSAGES_CACHE_TIMEOUT = getattr(settings, 'BUCHAKTION_MESSAGES_CACHE_TIMEOUT', 300)
+BUCHAKTION_MAIL_BATCH_SIZE = getattr(settings, 'BUCHAKTION_MAIL_BATCH_SIZE', 50)
+BUCHAKTION_MAIL_MAX_ATTEMPTS = getattr(settings, 'BUCHAKTION_MAIL_MAX_ATTEMPTS', 5)
+BUCHAKTION_MAIL_RETRY_DELAY = getattr(settings, 'BUCHAKTION_MAIL_RETRY_DELAY', 60)
+BUCHAKTION_MAIL_CLAIM_TIMEOUT = getattr(settings, 'BUCHAKTION_MAIL_CLAIM_TIMEOUT', 600)
+BUCHAKTION_TIMEFRAME_CACHE_TIMEOUT = getattr(settings, 'BUCHAKTION_TIMEFRAME_CACHE_TIMEOUT', 300)
+BUCHAKTION_MODULES_CACHE = getattr(settings, 'BUCHAKTION_MODULES_CACHE', 'default')
+BUCHAKTION_MODULES_CACHE_TIMEOUT = getattr(settings, 'BUCHAKTION_MODULES_CACHE_TIMEOUT', 300)
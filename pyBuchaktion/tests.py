@@ -1,3 +1,1126 @@
-from django.test import TestCase
+import os
+import json
+import time
+import logging
+import threading
 
-# Create your tests here.
+import tablib
+
+from datetime import date, timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core import mail as django_mail
+from django.core.cache import caches
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.core.mail.message import EmailMessage
+from django.core.urlresolvers import reverse
+from django.db import connection, transaction
+from django.db.models import F, Sum
+from django.template.loader import render_to_string
+from django.test import Client, RequestFactory, TestCase, TransactionTestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import translation
+
+from pyTUID.models import TUIDUser
+
+from . import mail, search
+from .admin import ModuleResource
+from .forms import ModuleSearchForm
+from .messages import drop_display_messages, get_message
+from .pagination import CursorPaginator
+from .settings import BUCHAKTION_MODULES_CACHE
+from .views import ModuleListView
+from .models import (
+    Book, BookSearchToken, DisplayMessage, Literature, Module, ModuleCategory, ModuleSearchToken,
+    Order, OrderTimeframe, OutboxMessage, Semester, Student, refresh_counters,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def login(client, user):
+    """
+        Puts the given TUID user into the session of the client, as the CAS
+        login would.
+    """
+    session = client.session
+    session['TUID'] = (user.uid, {
+        'surname': user.surname, 'givenName': user.given_name,
+        'mail': user.email, 'groupMembership': ['FB20'],
+    })
+    session.save()
+    client.cookies[settings.SESSION_COOKIE_NAME] = session.session_key
+
+
+class ModuleImportTest(TestCase):
+    """
+        Imports the modules of a TUCaN export and checks the literature
+        written in bulk, and that a dry run leaves the literature alone.
+    """
+
+    MODULES = 10
+
+    # The queries of an import regardless of its size: the modules,
+    # categories, semesters, books and literature are loaded once, and the
+    # literature is written in bulk, all within savepoints
+    IMPORT_QUERIES = 17
+
+    # The queries for each new module: its savepoint, its INSERT, its search
+    # tokens and the module count of its category. None are taken per book.
+    MODULE_QUERIES = 7
+
+    def setUp(self):
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        ModuleCategory.objects.create(name_de='Kategorie')
+        self.books = [
+            Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017)
+            for i in range(4)
+        ]
+        self.module = Module.objects.create(module_id='20-00-0000', name_de='Modul', last_offered=semester)
+        Literature.objects.create(module=self.module, book=self.books[0], source=Literature.TUCAN, in_tucan=True)
+        Literature.objects.create(module=self.module, book=self.books[1], source=Literature.STUDENT, in_tucan=True)
+        self.dataset = tablib.Dataset(headers=['module_id', 'name_de', 'name_en', 'category', 'last_offered', 'books'])
+        self.dataset.append(['20-00-0000', 'Modul', 'Module', 'Kategorie', 'W17', self.books[2].isbn_13])
+        self.dataset.append(['20-00-0001', 'Neu', 'New', 'Kategorie', 'W17', '%s, %s' % (self.books[2].isbn_13, self.books[3].isbn_13)])
+
+    def literature(self):
+        return set(Literature.objects.values_list('module__module_id', 'book__isbn_13', 'source', 'in_tucan'))
+
+    def test_import(self):
+        result = ModuleResource().import_data(self.dataset)
+        self.assertFalse(result.has_errors())
+        self.assertEqual(self.literature(), {
+            ('20-00-0000', self.books[1].isbn_13, Literature.STUDENT, False),
+            ('20-00-0000', self.books[2].isbn_13, Literature.TUCAN, True),
+            ('20-00-0001', self.books[2].isbn_13, Literature.TUCAN, True),
+            ('20-00-0001', self.books[3].isbn_13, Literature.TUCAN, True),
+        })
+        self.assertEqual(
+            dict(Module.objects.values_list('module_id', 'literature_count')),
+            {'20-00-0000': 2, '20-00-0001': 2},
+        )
+
+    def make_dataset(self, first, modules, books):
+        dataset = tablib.Dataset(headers=['module_id', 'name_de', 'name_en', 'category', 'last_offered', 'books'])
+        for i in range(first, first + modules):
+            isbns = ', '.join(book.isbn_13 for book in self.books[:books])
+            dataset.append(['20-01-%04d' % i, 'Modul %d' % i, 'Module %d' % i, 'Kategorie', 'W17', isbns])
+        return dataset
+
+    def test_query_count(self):
+        # New modules with a single book each, then with all the books
+        with self.assertNumQueries(self.IMPORT_QUERIES + self.MODULE_QUERIES * self.MODULES):
+            ModuleResource().import_data(self.make_dataset(0, self.MODULES, 1))
+        with self.assertNumQueries(self.IMPORT_QUERIES + self.MODULE_QUERIES * self.MODULES):
+            ModuleResource().import_data(self.make_dataset(self.MODULES, self.MODULES, len(self.books)))
+        self.assertEqual(Literature.objects.filter(module__module_id__startswith='20-01').count(), self.MODULES * (1 + len(self.books)))
+
+    def test_log(self):
+        with self.assertLogs('pyBuchaktion.admin') as logs:
+            ModuleResource().import_data(self.dataset)
+        self.assertRegex(logs.output[0], r'Imported 2 modules in [0-9.]+s$')
+        with override_settings(DEBUG=True), self.assertLogs('pyBuchaktion.admin') as logs:
+            ModuleResource().import_data(self.dataset)
+        self.assertRegex(logs.output[0], r'Imported 2 modules in [0-9.]+s with [0-9]+ queries$')
+
+    def test_dry_run(self):
+        before = self.literature()
+        for using_transactions in (True, False):
+            result = ModuleResource().import_data(self.dataset, dry_run=True, use_transactions=using_transactions)
+            self.assertFalse(result.has_errors())
+            self.assertEqual(self.literature(), before)
+
+
+class OutboxTest(TestCase):
+    """
+        Claims and sends the messages in the outbox and checks that every
+        message is sent once, from the sender it was queued with.
+    """
+
+    def setUp(self):
+        OutboxMessage.objects.enqueue(
+            EmailMessage(subject='Subject %d' % i, body='Body', from_email='sender@example.org', to=['%d@example.org' % i])
+            for i in range(5)
+        )
+
+    def test_claim(self):
+        first = OutboxMessage.objects.claim(3)
+        second = OutboxMessage.objects.claim(3)
+        self.assertEqual(len(first), 3)
+        self.assertEqual(len(second), 2)
+        self.assertFalse(set(first) & set(second))
+        self.assertEqual(OutboxMessage.objects.claim(3), [])
+
+    def test_send(self):
+        self.assertEqual(mail.send_outbox(10), 5)
+        self.assertEqual(mail.send_outbox(10), 0)
+        self.assertEqual(len(django_mail.outbox), 5)
+        self.assertEqual({message.from_email for message in django_mail.outbox}, {'sender@example.org'})
+        self.assertFalse(OutboxMessage.objects.exclude(state=OutboxMessage.SENT).exists())
+
+
+class MailRenderingBenchmark(TestCase):
+    """
+        Renders order notifications for 1,000 recipients, once with the
+        shared fragments of a batch and once with every message on its own.
+    """
+
+    RECIPIENTS = 1000
+
+    def setUp(self):
+        self.orders = []
+        for i in range(self.RECIPIENTS):
+            user = TUIDUser(uid='ab%06d' % i, given_name='Given', surname='Surname %d' % i, email='%d@example.org' % i)
+            student = Student(pk=i, tuid_user=user, language=('de', 'en', None)[i % 3])
+            book = Book(pk=i, isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017)
+            self.orders.append(Order(pk=i, book=book, student=student, hint='Hint %d' % i if i % 2 else ''))
+
+    def render(self, fragments):
+        sites = mail.Site.objects
+        with mock.patch.object(sites, 'get_current', wraps=sites.get_current) as get_current:
+            messages = [mail.OrderArrivedMessage(order, fragments) for order in self.orders]
+        return messages, get_current.call_count
+
+    def test_batch_rendering(self):
+        single, single_lookups = self.render(None)
+        batch, batch_lookups = self.render(mail.MessageFragments())
+
+        self.assertEqual(
+            [(message.subject, message.body) for message in single],
+            [(message.subject, message.body) for message in batch],
+        )
+        # Students without a preferred language get their mail in both languages
+        self.assertEqual(single_lookups, self.RECIPIENTS + self.RECIPIENTS // 3)
+        self.assertEqual(batch_lookups, 2)
+        for message, order in zip(batch, self.orders):
+            self.assertIn('/order/%d/"' % order.pk, message.body)
+
+
+class OrderActionTest(TestCase):
+    """
+        Rejects some orders with the admin action and checks that they are
+        updated in one query, the counters of their books are refreshed and
+        one notification per order is queued from a single template.
+    """
+
+    def setUp(self):
+        today = date.today()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        timeframe = OrderTimeframe.objects.create(
+            semester=semester, start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+            allowed_orders=4, spendings=100,
+        )
+        self.books = [
+            Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            for i in range(2)
+        ]
+        self.orders = []
+        for i in range(4):
+            user = TUIDUser.objects.create(uid='ab%06d' % i, given_name='Given', surname='Surname', email='%d@example.org' % i, groups='')
+            student = Student.objects.create(tuid_user=user, library_id=str(i), language='de')
+            self.orders.append(Order.objects.create(book=self.books[i % 2], student=student, order_timeframe=timeframe))
+
+    def test_update_selected(self):
+        order_admin = admin.site._registry[Order]
+        request = RequestFactory().post('/', {'hint': 'Out of print', '_sendmails': '1'})
+        selected = Order.objects.filter(pk__in=[order.pk for order in self.orders[:3]])
+        render_template = mail.OrderRejectedMessage.render_template
+
+        with mock.patch.object(order_admin, 'message_user'), \
+                mock.patch.object(mail.OrderRejectedMessage, 'render_template', autospec=True, side_effect=render_template) as render, \
+                CaptureQueriesContext(connection) as queries:
+            order_admin.update_selected(request, selected, Order.REJECTED, mail.OrderRejectedMessage)
+
+        order_updates = [query for query in queries if query['sql'].startswith('UPDATE "pyBuchaktion_order"')]
+        self.assertEqual(len(order_updates), 1)
+        self.assertEqual(render.call_count, 1)
+        self.assertEqual(
+            list(Book.objects.order_by('pk').values_list('order_count', 'pending_order_count', 'rejected_order_count')),
+            [(2, 0, 2), (2, 1, 1)],
+        )
+        self.assertEqual(
+            sorted(OutboxMessage.objects.values_list('to', flat=True)),
+            ['%d@example.org' % i for i in range(3)],
+        )
+        for message in OutboxMessage.objects.all():
+            self.assertIn("Out of print", message.body)
+
+
+@skipUnless(connection.features.has_select_for_update, "needs a database with row-level locking, such as PostgreSQL")
+class OrderPlacementStressTest(TransactionTestCase):
+    """
+        Lets many threads place orders for a few students at the same time
+        and checks that no student ends up with more orders than allowed.
+        This only runs against a database with row-level locking, SQLite
+        serializes all writes anyway.
+    """
+
+    THREADS = 24
+    STUDENTS = 3
+    ORDERS_PER_THREAD = 5
+    ALLOWED_ORDERS = 7
+
+    # The number of order attempts per second that have to be handled
+    MIN_THROUGHPUT = 20
+
+    def setUp(self):
+        today = date.today()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        OrderTimeframe.objects.create(
+            semester=semester, start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+            allowed_orders=self.ALLOWED_ORDERS, spendings=100,
+        )
+        self.students = []
+        for i in range(self.STUDENTS):
+            user = TUIDUser.objects.create(uid='ab%06d' % i, given_name='Given', surname='Surname', email='%d@example.org' % i, groups='')
+            self.students.append(Student.objects.create(tuid_user=user, library_id=str(i)))
+        self.books = [
+            Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            for i in range(self.ORDERS_PER_THREAD)
+        ]
+
+    def test_concurrent_orders(self):
+        placed = []
+        rejected = []
+        barrier = threading.Barrier(self.THREADS)
+
+        def place_orders(index):
+            try:
+                student = Student.objects.get(pk=self.students[index % self.STUDENTS].pk)
+                barrier.wait()
+                for book in self.books:
+                    try:
+                        placed.append(Order.objects.place(student, book).pk)
+                    except ValidationError as e:
+                        rejected.append(e.code)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=place_orders, args=(i,)) for i in range(self.THREADS)]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        throughput = self.THREADS * self.ORDERS_PER_THREAD / (time.perf_counter() - started)
+        logger.info("Placed orders from %d threads at %.0f attempts/s", self.THREADS, throughput)
+
+        for student in self.students:
+            self.assertEqual(Order.objects.filter(student=student).count(), self.ALLOWED_ORDERS)
+        self.assertEqual(len(placed), self.STUDENTS * self.ALLOWED_ORDERS)
+        self.assertEqual(len(placed) + len(rejected), self.THREADS * self.ORDERS_PER_THREAD)
+        self.assertEqual(set(rejected), {'no_budget_left'})
+        self.assertGreater(throughput, self.MIN_THROUGHPUT)
+
+
+class OrderPlacementTest(TestCase):
+    """
+        Places orders one after another and checks that the budget of the
+        current timeframe is enforced.
+    """
+
+    ALLOWED_ORDERS = 2
+
+    def setUp(self):
+        today = date.today()
+        self.semester = Semester.objects.create(season='W', year=17, budget=100)
+        self.timeframe = OrderTimeframe.objects.create(
+            semester=self.semester, start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+            allowed_orders=self.ALLOWED_ORDERS, spendings=100,
+        )
+        user = TUIDUser.objects.create(uid='ab123456', given_name='Given', surname='Surname', email='0@example.org', groups='')
+        self.student = Student.objects.create(tuid_user=user, library_id='0')
+        self.books = [
+            Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            for i in range(self.ALLOWED_ORDERS + 1)
+        ]
+
+    def test_budget(self):
+        for book in self.books[:self.ALLOWED_ORDERS]:
+            order = Order.objects.place(self.student, book)
+            self.assertEqual((order.status, order.order_timeframe), (Order.PENDING, self.timeframe))
+        with self.assertRaises(ValidationError) as context:
+            Order.objects.place(self.student, self.books[-1])
+        self.assertEqual(context.exception.code, 'no_budget_left')
+        self.assertEqual(Order.objects.filter(student=self.student).count(), self.ALLOWED_ORDERS)
+
+        # Another timeframe of the semester adds to the budget
+        today = date.today()
+        OrderTimeframe.objects.create(
+            semester=self.semester, start_date=today - timedelta(days=3), end_date=today - timedelta(days=2),
+            allowed_orders=1, spendings=0,
+        )
+        Order.objects.place(self.student, self.books[-1])
+        self.assertEqual(Order.objects.filter(student=self.student).count(), self.ALLOWED_ORDERS + 1)
+
+    def test_no_timeframe(self):
+        self.timeframe.delete()
+        with self.assertRaises(ValidationError) as context:
+            Order.objects.place(self.student, self.books[0])
+        self.assertEqual(context.exception.code, 'no_timeframe')
+
+    def test_missing_student(self):
+        student = Student(pk=self.student.pk + 1)
+        with self.assertRaises(Student.DoesNotExist):
+            Order.objects.place(student, self.books[0])
+        self.assertFalse(Order.objects.exists())
+
+
+class StudentBudgetTest(TestCase):
+    """
+        Compares the budget of a student, taken from the cached timeframes
+        with a single query for the orders, with the budget counted in the
+        database as before, on dates in and between several timeframes.
+    """
+
+    def setUp(self):
+        self.today = date.today()
+        first = Semester.objects.create(season='W', year=17, budget=100)
+        second = Semester.objects.create(season='S', year=18, budget=100)
+        self.timeframes = [
+            OrderTimeframe.objects.create(
+                semester=semester, start_date=self.today + timedelta(days=start), end_date=self.today + timedelta(days=end),
+                allowed_orders=allowed, spendings=0,
+            ) for semester, start, end, allowed in (
+                (first, -30, -20, 2),
+                (first, -1, 1, 3),
+                (second, 10, 20, 4),
+            )
+        ]
+        self.books = [
+            Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            for i in range(4)
+        ]
+        self.students = []
+        for i in range(2):
+            user = TUIDUser.objects.create(uid='ab%06d' % i, given_name='Given', surname='Surname', email='%d@example.org' % i, groups='')
+            self.students.append(Student.objects.create(tuid_user=user, library_id=str(i)))
+        for student, book, timeframe in (
+            (self.students[0], self.books[0], self.timeframes[0]),
+            (self.students[0], self.books[1], self.timeframes[1]),
+            (self.students[0], self.books[2], self.timeframes[2]),
+            (self.students[1], self.books[0], self.timeframes[1]),
+        ):
+            Order.objects.create(book=book, student=student, order_timeframe=timeframe)
+
+    def counted_budget(self, student, date):
+        timeframes = OrderTimeframe.objects.filter(end_date__gte=date).order_by('end_date', 'pk')
+        timeframe = timeframes.filter(start_date__lte=date).first() or timeframes.filter(start_date__gt=date).first()
+        if not timeframe:
+            return None, 0, 0, False
+        allowed = OrderTimeframe.objects \
+            .filter(semester=timeframe.semester, start_date__lte=date) \
+            .aggregate(allowed=Sum('allowed_orders'))['allowed'] or 0
+        spent = Order.objects.filter(
+            student=student, order_timeframe__semester=timeframe.semester, order_timeframe__start_date__lte=date,
+        ).count()
+        return timeframe.pk, allowed, spent, timeframe.start_date <= date
+
+    def test_budget(self):
+        OrderTimeframe.objects.cached()
+        for days in (-40, -25, -10, 0, 5, 15, 30):
+            day = self.today + timedelta(days=days)
+            for student in self.students:
+                expected = self.counted_budget(student, day)
+                with self.assertNumQueries(1 if expected[0] else 0):
+                    budget = OrderTimeframe.objects.student_budget(student, day)
+                self.assertEqual(
+                    (budget.timeframe and budget.timeframe.pk, budget.allowed, budget.spent, budget.is_current),
+                    expected, "%+d days" % days,
+                )
+
+    def test_place_resets_budget(self):
+        student = self.students[1]
+        self.assertEqual((student.budget().allowed, student.budget().spent), (5, 1))
+        Order.objects.place(student, self.books[1])
+        self.assertNotIn('_budget', student.__dict__)
+        self.assertEqual((student.budget().allowed, student.budget().spent), (5, 2))
+
+
+class ModuleDetailQueryTest(TestCase):
+    """
+        Renders the page of a module with many books and orders and checks
+        that it stays within a fixed number of queries.
+    """
+
+    BOOKS = 30
+
+    # The module and its books
+    ANONYMOUS_QUERY_BUDGET = 2
+
+    # Session, user and student, then module, books and orders
+    STUDENT_QUERY_BUDGET = 6
+
+    def setUp(self):
+        today = date.today()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        timeframe = OrderTimeframe.objects.create(
+            semester=semester, start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+            allowed_orders=self.BOOKS, spendings=100,
+        )
+        self.user = TUIDUser.objects.create(uid='ab123456', given_name='Given', surname='Surname', email='0@example.org', groups="['FB20']")
+        student = Student.objects.create(tuid_user=self.user, library_id='0')
+        self.module = Module.objects.create(module_id='20-00-0000', name_de='Modul', last_offered=semester)
+        for i in range(self.BOOKS):
+            book = Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            Literature.objects.create(module=self.module, book=book, source=Literature.STUDENT if i % 3 else Literature.TUCAN)
+            if i % 2:
+                Order.objects.create(book=book, student=student, order_timeframe=timeframe)
+
+    def render(self):
+        url = reverse('pyBuchaktion:module', kwargs={'pk': self.module.pk})
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_student_query_budget(self):
+        login(self.client, self.user)
+        response, queries = self.render()
+        self.assertLessEqual(queries, self.STUDENT_QUERY_BUDGET)
+        books = response.context['literature'] + response.context['recommendations']
+        self.assertEqual(len(books), self.BOOKS)
+        self.assertEqual(sum(len(book.orderset) for book in books), self.BOOKS // 2)
+
+    def test_anonymous_query_budget(self):
+        response, queries = self.render()
+        self.assertLessEqual(queries, self.ANONYMOUS_QUERY_BUDGET)
+        self.assertEqual(len(response.context['literature']), self.BOOKS // 3)
+
+
+@skipUnless(os.environ.get('BUCHAKTION_BENCHMARKS'), "seeds 10,000 orders, set BUCHAKTION_BENCHMARKS to run it")
+class OrderListingBenchmark(TestCase):
+    """
+        Renders the order table of a student with many orders, once from
+        the plain orders of the student and once from the order listing.
+    """
+
+    STUDENTS = 20
+    ORDERS_PER_STUDENT = 500
+
+    @classmethod
+    def setUpTestData(cls):
+        today = date.today()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        timeframes = [
+            OrderTimeframe.objects.create(
+                semester=semester, start_date=today + timedelta(days=i), end_date=today + timedelta(days=i + 1),
+                allowed_orders=cls.ORDERS_PER_STUDENT, spendings=1000,
+            )
+            for i in range(0, 10, 2)
+        ]
+        Book.objects.bulk_create(
+            Book(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            for i in range(cls.ORDERS_PER_STUDENT)
+        )
+        books = list(Book.objects.order_by('pk'))
+        TUIDUser.objects.bulk_create(
+            TUIDUser(uid='ab%06d' % i, given_name='Given', surname='Surname', email='%d@example.org' % i, groups='')
+            for i in range(cls.STUDENTS)
+        )
+        Student.objects.bulk_create(
+            Student(tuid_user=user, library_id=str(i))
+            for i, user in enumerate(TUIDUser.objects.order_by('pk'))
+        )
+        statuses = [status for status, name in Order.STATE_CHOICES]
+        Order.objects.bulk_create(
+            Order(student=student, book=book, order_timeframe=timeframes[i % len(timeframes)],
+                  status=statuses[i % len(statuses)], hint='Hint' if i % 7 == 0 else '')
+            for student in Student.objects.all()
+            for i, book in enumerate(books)
+        )
+        cls.student = Student.objects.first()
+
+    def render(self, orders):
+        with CaptureQueriesContext(connection) as queries:
+            html = render_to_string('pyBuchaktion/tags/table_orders.html', {'orders': orders})
+        return html, len(queries)
+
+    def test_order_listing(self):
+        plain, plain_queries = self.render(self.student.order_set.all())
+        listing, listing_queries = self.render(Order.objects.listing().filter(student=self.student))
+
+        self.assertEqual(plain, listing)
+        self.assertEqual(listing_queries, 1)
+        self.assertGreater(plain_queries, self.ORDERS_PER_STUDENT)
+
+
+class CursorPaginationTest(TestCase):
+    """
+        Walks through a list of books with many equal titles page by page,
+        forwards and backwards, and checks that every book shows up once
+        and in order.
+    """
+
+    BOOKS = 95
+    PER_PAGE = 10
+
+    def setUp(self):
+        Book.objects.bulk_create(
+            Book(isbn_13='978%010d' % i, title='Title %d' % (i % 7), author='Author', publisher='Publisher', year=2017)
+            for i in range(self.BOOKS)
+        )
+
+    def test_walk(self):
+        expected = list(Book.objects.order_by('title', 'pk'))
+        paginator = CursorPaginator(Book.objects.all(), self.PER_PAGE)
+
+        forward = []
+        page = paginator.page()
+        self.assertFalse(page.has_previous())
+        while True:
+            forward += page.object_list
+            if not page.has_next():
+                break
+            with CaptureQueriesContext(connection) as queries:
+                page = paginator.page(after=page.next_page_params()['after'])
+            self.assertEqual(len(queries), 1)
+        self.assertEqual(forward, expected)
+
+        backward = list(page.object_list)
+        while page.has_previous():
+            page = paginator.page(before=page.previous_page_params()['before'])
+            backward = page.object_list + backward
+        self.assertEqual(backward, expected)
+
+    def test_expression_ordering(self):
+        expected = list(Book.objects.order_by('-title', 'pk'))
+        paginator = CursorPaginator(Book.objects.order_by(F('title').desc(), 'pk'), self.PER_PAGE)
+        page = paginator.page()
+        page = paginator.page(after=page.next_page_params()['after'])
+        self.assertEqual(page.object_list, expected[self.PER_PAGE:2 * self.PER_PAGE])
+        with self.assertRaises(ValueError):
+            CursorPaginator(Book.objects.order_by('?'), self.PER_PAGE)
+
+    def test_page_parameter(self):
+        response = self.client.get(reverse('pyBuchaktion:books') + '?page=3')
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('page=3', response.content.decode())
+
+
+class DisplayMessageCacheTest(TransactionTestCase):
+    """
+        Edits a display message and checks that the cached messages are
+        dropped once the change is committed, and that they expire after
+        BUCHAKTION_MESSAGES_CACHE_TIMEOUT seconds otherwise.
+    """
+
+    TIMEOUT = 300
+
+    def setUp(self):
+        drop_display_messages()
+        self.message = DisplayMessage.objects.create(key='orders_none_found', text_de='Alt', text_en='Old')
+        self.addCleanup(drop_display_messages)
+
+    def edit(self):
+        with transaction.atomic():
+            self.message.text_de = 'Neu'
+            self.message.save()
+            # Not committed yet, so the old text may still be read
+            self.assertEqual(get_message('orders_none_found'), 'Alt')
+
+    def test_invalidation(self):
+        with translation.override('de'):
+            self.assertEqual(get_message('orders_none_found'), 'Alt')
+            self.edit()
+            self.assertEqual(get_message('orders_none_found'), 'Neu')
+
+    def test_shared_cache_invalidation(self):
+        with mock.patch('pyBuchaktion.messages.BUCHAKTION_MESSAGES_CACHE', 'default'), translation.override('de'):
+            self.assertEqual(get_message('orders_none_found'), 'Alt')
+            self.edit()
+            self.assertEqual(get_message('orders_none_found'), 'Neu')
+
+    def test_expiry(self):
+        with mock.patch('pyBuchaktion.messages.time') as clock, \
+                mock.patch('pyBuchaktion.messages.BUCHAKTION_MESSAGES_CACHE_TIMEOUT', self.TIMEOUT), \
+                translation.override('de'):
+            clock.monotonic.return_value = 1000
+            self.assertEqual(get_message('orders_none_found'), 'Alt')
+            # Bypasses the signals, as a change in another process would
+            DisplayMessage.objects.filter(pk=self.message.pk).update(text_de='Neu')
+            clock.monotonic.return_value = 1000 + self.TIMEOUT
+            self.assertEqual(get_message('orders_none_found'), 'Alt')
+            clock.monotonic.return_value = 1000 + self.TIMEOUT + 1
+            self.assertEqual(get_message('orders_none_found'), 'Neu')
+
+
+class TimeframeCacheTest(TransactionTestCase):
+    """
+        Checks that saving a timeframe changes the cached current and
+        upcoming timeframes, and that the copies handed out can be changed
+        without touching the cache.
+    """
+
+    def setUp(self):
+        self.today = date.today()
+        self.semester = Semester.objects.create(season='W', year=17, budget=100)
+        self.timeframe = OrderTimeframe.objects.create(
+            semester=self.semester, start_date=self.today - timedelta(days=1), end_date=self.today + timedelta(days=1),
+            allowed_orders=2, spendings=0,
+        )
+
+    def test_save(self):
+        self.assertEqual(OrderTimeframe.objects.current().pk, self.timeframe.pk)
+        self.timeframe.start_date = self.today + timedelta(days=5)
+        self.timeframe.end_date = self.today + timedelta(days=6)
+        self.timeframe.save()
+        self.assertIsNone(OrderTimeframe.objects.current())
+        self.assertEqual(OrderTimeframe.objects.upcoming().pk, self.timeframe.pk)
+
+        timeframe = OrderTimeframe.objects.create(
+            semester=self.semester, start_date=self.today, end_date=self.today,
+            allowed_orders=1, spendings=0,
+        )
+        self.assertEqual(OrderTimeframe.objects.current().pk, timeframe.pk)
+
+    def test_copy(self):
+        timeframe = OrderTimeframe.objects.current()
+        timeframe.allowed_orders = 10
+        timeframe.semester.budget = 0
+        with self.assertNumQueries(0):
+            timeframe = OrderTimeframe.objects.current()
+        self.assertEqual((timeframe.allowed_orders, timeframe.semester.budget), (2, 100))
+        self.assertEqual(OrderTimeframe.objects.semester_budget(self.semester), 2)
+
+
+class ModuleListingCacheTest(TransactionTestCase):
+    """
+        Renders the module categories twice and checks that the second time
+        is served from the cache, until a module or its literature changes.
+        The cache is only invalidated on commit, so this runs outside of a
+        test transaction.
+    """
+
+    def setUp(self):
+        caches[BUCHAKTION_MODULES_CACHE].clear()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        category = ModuleCategory.objects.create(name_de='Kategorie')
+        self.module = Module.objects.create(module_id='20-00-0000', name_de='Modul', last_offered=semester, category=category)
+        self.book = Book.objects.create(isbn_13='9780000000000', title='Title', author='Author', publisher='Publisher', year=2017)
+        Literature.objects.create(module=self.module, book=self.book)
+        self.url = reverse('pyBuchaktion:modules')
+
+    def render(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+        return response.content.decode(), len(queries)
+
+    def test_invalidation(self):
+        first, first_queries = self.render()
+        second, second_queries = self.render()
+        self.assertEqual(first, second)
+        self.assertLess(second_queries, first_queries)
+        self.assertIn('Modul', second)
+
+        self.module.name_de = 'Umbenannt'
+        self.module.save()
+        renamed, queries = self.render()
+        self.assertIn('Umbenannt', renamed)
+
+        self.assertIn('<span class="badge">1</span>', renamed)
+        Literature.objects.filter(module=self.module).delete()
+        emptied, queries = self.render()
+        self.assertIn('<span class="badge">0</span>', emptied)
+
+
+class QueryBudgetBenchmark(TestCase):
+    """
+        Seeds a realistic amount of data, renders every page of the site
+        and every admin changelist, and checks each of them against a budget
+        of queries. If BUCHAKTION_QUERY_REPORT is set, the measurements are
+        written to a JSON report at that path, so they can be tracked over
+        time. If BUCHAKTION_TIME_BUDGET is set, no page may take more seconds
+        than that to render.
+    """
+
+    BOOKS = 3000
+    CATEGORIES = 10
+    MODULES = 300
+    LITERATURE_PER_MODULE = 10
+    STUDENTS = 2000
+    ORDERS_PER_STUDENT = 10
+
+    # The number of seconds any page may take to render, if checked at all
+    TIME_BUDGET = float(os.environ['BUCHAKTION_TIME_BUDGET']) if os.environ.get('BUCHAKTION_TIME_BUDGET') else None
+
+    # The number of queries each page may take, by page name. Session, user
+    # and student lookups account for up to four of them. Pages are measured
+    # with warm caches, so the cached module listing takes none.
+    QUERY_BUDGETS = {
+        'books': 1,
+        'books_search': 2,
+        'books_all': 1,
+        'book': 3,
+        'modules': 0,
+        'module_search': 2,
+        'module': 2,
+        'student_books': 5,
+        'student_book': 7,
+        'student_module': 6,
+        'book_order': 6,
+        'book_propose': 3,
+        'addbook': 8,
+        'account': 6,
+        'account_delete': 3,
+        'order': 4,
+        'order_abort': 4,
+        'account_create': 3,
+        'admin:pyBuchaktion_book_changelist': 5,
+        'admin:pyBuchaktion_order_changelist': 9,
+        'admin:pyBuchaktion_student_changelist': 5,
+        'admin:pyBuchaktion_ordertimeframe_changelist': 6,
+        'admin:pyBuchaktion_semester_changelist': 5,
+        'admin:pyBuchaktion_module_changelist': 6,
+        'admin:pyBuchaktion_literature_changelist': 7,
+        'admin:pyBuchaktion_modulecategory_changelist': 5,
+        'admin:pyBuchaktion_displaymessage_changelist': 5,
+        'admin:pyBuchaktion_outboxmessage_changelist': 5,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        today = date.today()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        timeframe = OrderTimeframe.objects.create(
+            semester=semester, start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+            allowed_orders=cls.ORDERS_PER_STUDENT + 1, spendings=1000,
+        )
+
+        Book.objects.bulk_create(
+            Book(isbn_13='978%010d' % i, title='Title %d' % i, author='Author %d' % (i % 100),
+                 publisher='Publisher %d' % (i % 10), year=2000 + i % 18, price=10,
+                 state=Book.PROPOSED if i % 50 == 0 else Book.ACCEPTED)
+            for i in range(cls.BOOKS)
+        )
+        books = list(Book.objects.order_by('pk'))
+
+        ModuleCategory.objects.bulk_create(
+            ModuleCategory(name_de='Kategorie %d' % i, name_en='Category %d' % i)
+            for i in range(cls.CATEGORIES)
+        )
+        categories = list(ModuleCategory.objects.order_by('pk')) + [None]
+        Module.objects.bulk_create(
+            Module(module_id='20-00-%04d' % i, name_de='Modul %d' % i, name_en='Module %d' % i,
+                   last_offered=semester, category=categories[i % len(categories)])
+            for i in range(cls.MODULES)
+        )
+        modules = list(Module.objects.order_by('pk'))
+        Literature.objects.bulk_create(
+            Literature(module=module, book=books[(i * cls.LITERATURE_PER_MODULE + j) % cls.BOOKS],
+                       source=Literature.STUDENT if j % 4 == 0 else Literature.TUCAN)
+            for i, module in enumerate(modules)
+            for j in range(cls.LITERATURE_PER_MODULE)
+        )
+
+        TUIDUser.objects.bulk_create(
+            TUIDUser(uid='ab%06d' % i, given_name='Given', surname='Surname %d' % i,
+                     email='%d@example.org' % i, groups="['FB20']")
+            for i in range(cls.STUDENTS + 1)
+        )
+        users = list(TUIDUser.objects.order_by('pk'))
+        Student.objects.bulk_create(
+            Student(tuid_user=user, library_id=str(i), email=user.email)
+            for i, user in enumerate(users[:cls.STUDENTS])
+        )
+        students = list(Student.objects.order_by('pk'))
+        statuses = [status for status, name in Order.STATE_CHOICES]
+        Order.objects.bulk_create(
+            Order(student=student, book=books[(i * 7 + j * 13) % cls.BOOKS], order_timeframe=timeframe,
+                  status=statuses[(i + j) % len(statuses)])
+            for i, student in enumerate(students)
+            for j in range(cls.ORDERS_PER_STUDENT)
+        )
+
+        for model in (Book, Student, Module, ModuleCategory):
+            refresh_counters(model)
+        BookSearchToken.objects.rebuild(Book.objects.all())
+        ModuleSearchToken.objects.rebuild(Module.objects.all())
+
+        cls.student = students[0]
+        cls.unregistered = users[cls.STUDENTS]
+        cls.book = books[1]
+        cls.module = modules[1]
+        cls.order = Order.objects.filter(student=cls.student).first()
+        cls.admin = User.objects.create_superuser('admin', 'admin@example.org', 'admin')
+
+    def pages(self):
+        """
+            The pages to render as tuples of name, client and url.
+        """
+        anonymous = Client()
+        student = Client()
+        login(student, self.student.tuid_user)
+        unregistered = Client()
+        login(unregistered, self.unregistered)
+        staff = Client()
+        staff.force_login(self.admin)
+
+        book = {'pk': self.book.pk}
+        module = {'pk': self.module.pk}
+        order = {'pk': self.order.pk}
+        pages = [
+            ('books', anonymous, reverse('pyBuchaktion:books')),
+            ('books_search', anonymous, reverse('pyBuchaktion:books') + '?title=title+1&limit=100'),
+            ('books_all', anonymous, reverse('pyBuchaktion:books_all') + '?limit=100'),
+            ('book', anonymous, reverse('pyBuchaktion:book', kwargs=book)),
+            ('modules', anonymous, reverse('pyBuchaktion:modules')),
+            ('module_search', anonymous, reverse('pyBuchaktion:module_search') + '?name=modul&limit=100'),
+            ('module', anonymous, reverse('pyBuchaktion:module', kwargs=module)),
+            ('student_books', student, reverse('pyBuchaktion:books') + '?limit=100'),
+            ('student_book', student, reverse('pyBuchaktion:book', kwargs=book)),
+            ('student_module', student, reverse('pyBuchaktion:module', kwargs=module)),
+            ('book_order', student, reverse('pyBuchaktion:book_order', kwargs=book)),
+            ('book_propose', student, reverse('pyBuchaktion:book_propose')),
+            ('addbook', student, reverse('pyBuchaktion:addbook', kwargs=module)),
+            ('account', student, reverse('pyBuchaktion:account')),
+            ('account_delete', student, reverse('pyBuchaktion:account_delete')),
+            ('order', student, reverse('pyBuchaktion:order', kwargs=order)),
+            ('order_abort', student, reverse('pyBuchaktion:order_abort', kwargs=order)),
+            ('account_create', unregistered, reverse('pyBuchaktion:account_create')),
+        ]
+        for model, model_admin in admin.site._registry.items():
+            if model._meta.app_label == 'pyBuchaktion':
+                name = 'admin:%s_%s_changelist' % (model._meta.app_label, model._meta.model_name)
+                pages.append((name, staff, reverse(name)))
+        return pages
+
+    def measure(self, client, url):
+        # A first request fills the caches, as on a running site
+        client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            started = time.perf_counter()
+            response = client.get(url)
+            elapsed = time.perf_counter() - started
+        return response.status_code, len(queries), elapsed
+
+    def write_report(self, results):
+        path = os.environ.get('BUCHAKTION_QUERY_REPORT')
+        if not path:
+            return
+        with open(path, 'w') as report:
+            json.dump({
+                'dataset': {
+                    'books': self.BOOKS,
+                    'modules': self.MODULES,
+                    'literature': self.MODULES * self.LITERATURE_PER_MODULE,
+                    'students': self.STUDENTS,
+                    'orders': self.STUDENTS * self.ORDERS_PER_STUDENT,
+                },
+                'time_budget': self.TIME_BUDGET,
+                'pages': results,
+            }, report, indent=2)
+
+    def test_query_budgets(self):
+        results = []
+        for name, client, url in self.pages():
+            status, queries, elapsed = self.measure(client, url)
+            results.append({
+                'name': name,
+                'url': url,
+                'status': status,
+                'queries': queries,
+                'query_budget': self.QUERY_BUDGETS.get(name),
+                'time': round(elapsed, 4),
+            })
+        self.write_report(results)
+
+        for result in results:
+            with self.subTest(page=result['name']):
+                self.assertIn(result['name'], self.QUERY_BUDGETS)
+                self.assertEqual(result['status'], 200)
+                self.assertLessEqual(result['queries'], result['query_budget'])
+                if self.TIME_BUDGET is not None:
+                    self.assertLessEqual(result['time'], self.TIME_BUDGET)
+
+
+class CounterDeletionTest(TestCase):
+    """
+        Deletes many orders at once and checks that the counters of their
+        books and student are refreshed once, not once per order.
+    """
+
+    ORDERS = 20
+
+    def setUp(self):
+        today = date.today()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        timeframe = OrderTimeframe.objects.create(
+            semester=semester, start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+            allowed_orders=self.ORDERS, spendings=100,
+        )
+        user = TUIDUser.objects.create(uid='ab123456', given_name='Given', surname='Surname', email='0@example.org', groups='')
+        self.student = Student.objects.create(tuid_user=user, library_id='0')
+        self.books = [
+            Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            for i in range(2)
+        ]
+        for i in range(self.ORDERS):
+            Order.objects.create(book=self.books[i % 2], student=self.student, order_timeframe=timeframe)
+
+    def test_queryset_delete(self):
+        self.assertEqual(Student.objects.get(pk=self.student.pk).order_count, self.ORDERS)
+        with CaptureQueriesContext(connection) as queries:
+            Order.objects.filter(student=self.student).delete()
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 2)
+        self.assertEqual(Student.objects.get(pk=self.student.pk).order_count, 0)
+        self.assertEqual(list(Book.objects.values_list('order_count', flat=True)), [0, 0])
+
+
+class CounterTest(TestCase):
+    """
+        Creates and moves orders and adds and removes literature and checks
+        that the counters follow, and that a full save neither writes back
+        outdated counters nor recounts them.
+    """
+
+    def setUp(self):
+        today = date.today()
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        self.timeframe = OrderTimeframe.objects.create(
+            semester=semester, start_date=today - timedelta(days=1), end_date=today + timedelta(days=1),
+            allowed_orders=4, spendings=100,
+        )
+        user = TUIDUser.objects.create(uid='ab123456', given_name='Given', surname='Surname', email='0@example.org', groups='')
+        self.student = Student.objects.create(tuid_user=user, library_id='0')
+        self.books = [
+            Book.objects.create(isbn_13='978%010d' % i, title='Title %d' % i, author='Author', publisher='Publisher', year=2017, price=10)
+            for i in range(2)
+        ]
+        self.module = Module.objects.create(module_id='20-00-0000', name_de='Modul', last_offered=semester)
+
+    def assertCounters(self, books, student):
+        self.assertEqual(list(Book.objects.order_by('pk').values_list('order_count', flat=True)), books)
+        self.assertEqual(Student.objects.get(pk=self.student.pk).order_count, student)
+        out = StringIO()
+        call_command('buchaktion_counters', verify=True, stdout=out, stderr=StringIO())
+        self.assertIn("All counters are correct", out.getvalue())
+
+    def test_create_order(self):
+        Order.objects.create(book=self.books[0], student=self.student, order_timeframe=self.timeframe)
+        self.assertCounters([1, 0], 1)
+
+    def test_move_order(self):
+        order = Order.objects.create(book=self.books[0], student=self.student, order_timeframe=self.timeframe)
+        order = Order.objects.get(pk=order.pk)
+        order.book = self.books[1]
+        order.save()
+        self.assertCounters([0, 1], 1)
+
+    def test_literature(self):
+        literature = Literature.objects.create(module=self.module, book=self.books[0])
+        Literature.objects.create(module=self.module, book=self.books[1])
+        self.assertEqual(Module.objects.get(pk=self.module.pk).literature_count, 2)
+        literature.delete()
+        self.assertEqual(Module.objects.get(pk=self.module.pk).literature_count, 1)
+        self.assertCounters([0, 0], 0)
+
+    def test_full_save(self):
+        book = Book.objects.get(pk=self.books[0].pk)
+        Order.objects.create(book=book, student=self.student, order_timeframe=self.timeframe)
+        book.title = 'New Title'
+        with CaptureQueriesContext(connection) as queries:
+            book.save()
+        updates = [query for query in queries if query['sql'].startswith('UPDATE')]
+        self.assertEqual(len(updates), 1)
+        self.assertNotIn('order_count', updates[0]['sql'])
+        self.assertEqual(Book.objects.get(pk=book.pk).title, 'New Title')
+        self.assertCounters([1, 0], 1)
+
+
+class BookSearchTest(TestCase):
+    """
+        Searches books through the token index by prefixes of their words,
+        by ISBN prefixes and with misspelled words.
+    """
+
+    def setUp(self):
+        def create(isbn_13, title, author):
+            return Book.objects.create(isbn_13=isbn_13, title=title, author=author, publisher='Publisher', year=2017)
+        self.datenstrukturen = create('9783827428035', 'Algorithmen und Datenstrukturen', 'Ottmann')
+        self.design = create('9780321295354', 'Algorithm Design', 'Kleinberg')
+        self.algorithmik = create('9783642054228', 'Algorithmik', 'Schöning')
+        self.compiler = create('9780321486813', 'Compilers', 'Aho')
+        self.search = BookSearchToken.objects.search
+
+    def test_ranking(self):
+        result = list(self.search(Book.objects.all(), {'title': 'algorithm'}))
+        self.assertEqual(result[0], self.design)
+        self.assertEqual(set(result), {self.design, self.datenstrukturen, self.algorithmik})
+        self.assertEqual(list(self.search(Book.objects.all(), {'title': 'algo', 'author': 'scho'})), [self.algorithmik])
+
+    def test_isbn_prefix(self):
+        self.assertEqual(list(self.search(Book.objects.all(), {'isbn_13': '978-3-8274'})), [self.datenstrukturen])
+        # The ISBN-10 is indexed as well
+        self.assertEqual(list(self.search(Book.objects.all(), {'isbn_13': '3-642-05422'})), [self.algorithmik])
+
+    def test_prefix_end(self):
+        self.assertEqual(search.prefix_end('ab'), 'ac')
+        self.assertEqual(search.prefix_end('a\U0010ffff'), 'b')
+        self.assertIsNone(search.prefix_end('\U0010ffff'))
+        self.assertEqual(search.prefix_end('a\ud7ff'), 'a\ue000')
+
+        # Characters beyond U+FFFF still fall into the range of their prefix
+        wide = Book.objects.create(isbn_13='9780000000000', title='Comp\U00020000', author='Author', publisher='Publisher', year=2017)
+        Book.objects.create(isbn_13='9780000000001', title='Comq', author='Author', publisher='Publisher', year=2017)
+        self.assertEqual(set(self.search(Book.objects.all(), {'title': 'comp'})), {self.compiler, wide})
+
+    def test_correct(self):
+        correct = BookSearchToken.objects.correct
+        self.assertEqual(correct(search.TITLE, 'algoritmen'), 'algorithmen')
+        self.assertEqual(correct(search.TITLE, 'algo'), 'algo')
+        self.assertEqual(correct(search.TITLE, 'alg'), 'alg')
+        self.assertEqual(correct(search.ISBN, '9783827428036'), '9783827428036')
+        self.assertEqual(list(self.search(Book.objects.all(), {'title': 'Algoritmen'})), [self.datenstrukturen])
+        self.assertFalse(self.search(Book.objects.all(), {'title': 'Zzzzzz'}).exists())
+
+
+class ModuleSearchTest(TestCase):
+    """
+        Searches modules by their folded names and by module id prefixes,
+        and lists only modules with literature.
+    """
+
+    def setUp(self):
+        semester = Semester.objects.create(season='W', year=17, budget=100)
+        self.exercise = Module.objects.create(module_id='20-00-0004', name_de='Übung Algorithmen', name_en='Algorithms Exercise', last_offered=semester)
+        self.compiler = Module.objects.create(module_id='20-00-0005', name_de='Einführung in den Compilerbau', last_offered=semester)
+        self.other = Module.objects.create(module_id='20-01-0001', name_de='Größenordnungen', last_offered=semester)
+        book = Book.objects.create(isbn_13='9780000000000', title='Title', author='Author', publisher='Publisher', year=2017)
+        Literature.objects.create(module=self.exercise, book=book)
+        Literature.objects.create(module=self.other, book=book)
+        self.search = ModuleSearchToken.objects.search
+
+    def test_fold(self):
+        self.assertEqual(search.fold('Größe'), 'grosse')
+        self.assertEqual(search.fold('ÜBUNG'), 'ubung')
+        self.assertEqual(list(self.search(Module.objects.all(), {'name': 'ubung'})), [self.exercise])
+        self.assertEqual(list(self.search(Module.objects.all(), {'name': 'EINFUHR'})), [self.compiler])
+        self.assertEqual(list(self.search(Module.objects.all(), {'name': 'grossen'})), [self.other])
+        # The english name is searched as well
+        self.assertEqual(list(self.search(Module.objects.all(), {'name': 'exercise'})), [self.exercise])
+
+    def test_module_id_prefix(self):
+        self.assertEqual(list(self.search(Module.objects.all(), {'module_id': '20-00-00'})), [self.exercise, self.compiler])
+        self.assertEqual(list(self.search(Module.objects.all(), {'module_id': '200100'})), [self.other])
+        self.assertEqual(list(self.search(Module.objects.all(), {'module_id': '20 00 0005'})), [self.compiler])
+
+    def test_literature_count(self):
+        self.assertEqual(
+            dict(Module.objects.values_list('module_id', 'literature_count')),
+            {'20-00-0004': 1, '20-00-0005': 0, '20-01-0001': 1},
+        )
+        view = ModuleListView()
+        view.request = RequestFactory().get('/', {'module_id': '20-00'})
+        view.request.form = ModuleSearchForm(view.request.GET)
+        view.kwargs = {}
+        self.assertEqual(list(view.get_queryset()), [self.exercise])
+        view.request.form = ModuleSearchForm({})
+        self.assertEqual(list(view.get_queryset()), [self.exercise, self.other])
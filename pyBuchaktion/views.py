@@ -2,14 +2,18 @@ from django.views.generic import ListView, DetailView, TemplateView
 from django.views.generic.edit import UpdateView, CreateView, BaseCreateView, DeleteView
 from django.core.urlresolvers import reverse
 from django.core.exceptions import ValidationError
+from django.core.paginator import InvalidPage
 from django.utils.translation import get_language
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, Http404
 from django.shortcuts import render
-from django.db.models import F, Count, ExpressionWrapper, Prefetch, ProtectedError
+from django.db import transaction
+from django.db.models import F, ExpressionWrapper, Prefetch, ProtectedError
 
 from .forms import BookSearchForm, ModuleSearchForm, AccountEditForm, BookOrderForm, BookProposeForm, LiteratureCreateForm
-from .models import Book, Module, Order, Student, OrderTimeframe, ModuleCategory, Literature
+from .models import Book, BookSearchToken, Module, ModuleSearchToken, Order, Student, ModuleCategory, Literature, module_listing_generation
 from .mixins import SearchFormContextMixin, StudentRequestMixin, StudentRequiredMixin, NeverCacheMixin, UnregisteredStudentRequiredMixin
+from .pagination import CursorPaginator
+from .settings import BUCHAKTION_MODULES_CACHE, BUCHAKTION_MODULES_CACHE_TIMEOUT
 
 
 class VarPagedListView(ListView):
@@ -23,14 +27,20 @@ class VarPagedListView(ListView):
     paginate_by_default = 10
     # The options for pagination
     paginate_by_options = [10, 25, 50, 100]
+    # Whether to paginate with a cursor on the ordering instead of page
+    # numbers, which needs neither a count query nor an offset
+    paginate_by_cursor = False
 
-    # Get the paginate by value
+    # Get the paginate by value, at most the largest option
     def get_paginate_by(self, queryset):
         opts = self.request.GET
         if 'limit' in opts:
             try:
                 limit = int(opts['limit'])
-                self.paginate_by = limit
+                if limit > 0:
+                    self.paginate_by = min(limit, max(self.paginate_by_options))
+                else:
+                    self.paginate_by = self.paginate_by_default
             except (TypeError, ValueError):
                 self.paginate_by = self.paginate_by_default
         else:
@@ -38,11 +48,26 @@ class VarPagedListView(ListView):
 
         return self.paginate_by
 
+    # Paginate with a cursor if enabled, the pages then have no numbers
+    def paginate_queryset(self, queryset, page_size):
+        if not self.paginate_by_cursor:
+            return super().paginate_queryset(queryset, page_size)
+        paginator = CursorPaginator(queryset, page_size)
+        try:
+            page = paginator.page(self.request.GET.get('after'), self.request.GET.get('before'))
+        except InvalidPage as e:
+            raise Http404(str(e))
+        return paginator, page, page.object_list, page.has_other_pages()
+
     # Overwrite the context to add information on pagination
     # as well as the GET parameters
     def get_context_data(self, **kwargs):
         context = super(ListView, self).get_context_data(**kwargs)
-        context['get_params'] = self.request.GET
+        params = self.request.GET.copy()
+        if self.paginate_by_cursor:
+            # Cursor pages have no numbers, so links must not carry one
+            params.pop('page', None)
+        context['get_params'] = params
         context['limit_data'] = {
             'options': self.paginate_by_options,
             'default': self.paginate_by_default,
@@ -61,6 +86,10 @@ class BookListView(StudentRequestMixin, SearchFormContextMixin, VarPagedListView
     form_class = BookSearchForm
     template_name = 'pyBuchaktion/books/active_list.html'
     context_object_name = 'books'
+    paginate_by_cursor = True
+
+    def get_form_queryset(self, data, queryset):
+        return BookSearchToken.objects.search(queryset, data)
 
     def get_queryset(self):
         queryset = super().get_queryset()
@@ -112,13 +141,22 @@ class BookOrderView(StudentRequiredMixin, NeverCacheMixin, CreateView):
             book = Book.objects.get(pk=self.kwargs['pk']),
             status = Order.PENDING,
             student = self.request.student,
-            order_timeframe = OrderTimeframe.objects.current(),
+            order_timeframe = self.request.student.budget().current_timeframe,
         )})
         return kwargs
 
+    def form_valid(self, form):
+        order = form.instance
+        try:
+            self.object = Order.objects.place(order.student, order.book)
+        except ValidationError as e:
+            form.add_error(None, e)
+            return self.form_invalid(form)
+        return HttpResponseRedirect(self.get_success_url())
+
     def get_context_data(self, **kwargs):
         context = super(BookOrderView, self).get_context_data(**kwargs)
-        timeframe = OrderTimeframe.objects.current();
+        timeframe = self.request.student.budget().current_timeframe
         if timeframe:
             context.update({'current_timeframe': timeframe.end_date})
         try:
@@ -139,14 +177,14 @@ class ModuleListView(StudentRequestMixin, SearchFormContextMixin, VarPagedListVi
     template_name = 'pyBuchaktion/module_list.html'
     context_object_name = 'modules'
     form_class = ModuleSearchForm
+    paginate_by_cursor = True
 
     def get_queryset(self):
         queryset = super().get_queryset()
-        return queryset.annotate(book_count=Count('literature')).filter(book_count__gt=0)
+        return queryset.filter(literature_count__gt=0)
 
-    def get_localized_field(self, field_key):
-        if field_key == 'name':
-            return 'name_' + get_language()
+    def get_form_queryset(self, data, queryset):
+        return ModuleSearchToken.objects.search(queryset, data)
 
 
 class ModuleDetailView(StudentRequestMixin, DetailView):
@@ -159,20 +197,14 @@ class ModuleDetailView(StudentRequestMixin, DetailView):
     template_name = 'pyBuchaktion/module.html'
     context_object_name = 'module'
 
+    def get_queryset(self):
+        return super().get_queryset().select_related('last_offered', 'category')
+
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        books = Book.objects.filter(literature_info__module=self.object)
-        books = books.filter(state=Book.ACCEPTED)
-        get_args = {'literature_info__source': Literature.STUDENT}
-        literature = books.exclude(**get_args)
-        recommendations = books.filter(**get_args)
-        if self.request.student:
-            literature = Order.objects.student_annotate_book_queryset(
-                self.request.student, literature,
-            ).all()
-            recommendations = Order.objects.student_annotate_book_queryset(
-                self.request.student, recommendations,
-            ).all()
+        literature, recommendations = Literature.objects.module_books(
+            self.object, self.request.student,
+        )
         context.update({
             'literature': literature,
             'recommendations': recommendations,
@@ -182,38 +214,43 @@ class ModuleDetailView(StudentRequestMixin, DetailView):
 
 class ModuleCategoriesView(StudentRequestMixin, ListView):
     """
-    The view that displays all modules within the respective category
+    The view that displays all modules within the respective category.
+    The listing is cached per language until a module, category or
+    literature entry changes.
     """
     model = ModuleCategory
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
-        context.update({'misc_module_list': Module.objects.filter(category=None)})
+        context.update({
+            'misc_module_list': Module.objects.filter(category=None),
+            'listing_cache': {
+                'name': BUCHAKTION_MODULES_CACHE,
+                'timeout': BUCHAKTION_MODULES_CACHE_TIMEOUT,
+                'generation': module_listing_generation(),
+            },
+        })
         return context
 
     def get_queryset(self):
         queryset = super().get_queryset()
         queryset = queryset.filter(visible=True)
-        queryset = queryset.annotate(module_count=Count('module'))
         queryset = queryset.filter(module_count__gt=0)
-        modules = Module.objects.annotate(book_count=Count('literature'))
-        queryset = queryset.prefetch_related(
-            Prefetch('module_set', queryset=modules)
-        )
+        queryset = queryset.prefetch_related('module_set')
         return queryset
 
 
 class OrderListView(StudentRequiredMixin, NeverCacheMixin, VarPagedListView):
 
     def get_queryset(self):
-        return Order.objects.filter(student=self.request.student)
+        return Order.objects.listing().filter(student=self.request.student)
 
 
 class OrderDetailView(StudentRequiredMixin, NeverCacheMixin, DetailView):
 
     def get_queryset(self):
         student = self.request.student
-        return Order.objects.filter(student=student)
+        return Order.objects.listing().filter(student=student)
 
 
 class OrderAbortView(DeleteView, OrderDetailView):
@@ -245,24 +282,17 @@ class AccountView(StudentRequiredMixin, NeverCacheMixin, UpdateView):
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
 
-        timeframe = OrderTimeframe.objects.current()
-        if timeframe:
-            context_name = 'timeframe'
-        else:
-            timeframe = OrderTimeframe.objects.upcoming()
-            if timeframe:
-                context_name = 'timeframe_upcoming'
-
-        if timeframe:
-            budget_spent = Order.objects.student_semester_order_count(self.request.student, timeframe.semester)
-            budget_max = OrderTimeframe.objects.semester_budget(timeframe.semester)
+        context.update({'orders': Order.objects.listing().filter(student=self.request.student)})
 
+        budget = self.request.student.budget()
+        if budget.timeframe:
+            context_name = 'timeframe' if budget.is_current else 'timeframe_upcoming'
             context.update({
-                context_name: timeframe,
+                context_name: budget.timeframe,
                 'budget': {
-                    'spent': budget_spent,
-                    'max': budget_max,
-                    'left': budget_max - budget_spent,
+                    'spent': budget.spent,
+                    'max': budget.allowed,
+                    'left': budget.left,
                 },
             })
 
@@ -312,14 +342,13 @@ class BookProposeView(StudentRequiredMixin, CreateView):
 
     def form_valid(self, form):
         form.instance.state = Book.PROPOSED
-        result = super().form_valid(form)
-        order = Order(
-            book=form.instance,
-            student=self.request.student,
-            status=Order.PENDING,
-            order_timeframe=OrderTimeframe.objects.current()
-        )
-        order.save()
+        try:
+            with transaction.atomic():
+                result = super().form_valid(form)
+                Order.objects.place(self.request.student, form.instance)
+        except ValidationError as e:
+            form.add_error(None, e)
+            return self.form_invalid(form)
         return result
 
     def form_invalid(self, form):
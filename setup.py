@@ -55,10 +55,10 @@ setup(
     author='Buchaktionsteam D120',
     author_email='buchaktion@d120.de',
     setup_requires=[
-        'django>=1.10.0',
+        'django>=1.11.0',
     ],
     install_requires=[
-        'django>=1.10.0',
+        'django>=1.11.0',
         'django-import-export',
         'pyTUID>=1.3.3',
         'django-bootstrap3',
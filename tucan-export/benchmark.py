@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+
+# Offline benchmarks for the parts of tucan-export that do not need network
+# access. The fixtures are module pages saved from TUCaN (any *.html file) or
+# the module pages of an archive recorded with tucan-export.py --record.
+
+from argparse     import ArgumentParser
+from bs4          import BeautifulSoup
+from math         import floor
+from rapidfuzz.distance import Levenshtein
+from time         import perf_counter
+import importlib.util
+import lxml.html
+import os
+import timeit
+
+# tucan-export.py cannot be imported by its name, so load it from its path.
+spec = importlib.util.spec_from_file_location(
+    'tucan_export', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tucan-export.py'))
+export = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(export)
+
+
+
+###############
+##### I/O #####
+###############
+
+def loadPages(paths):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files += sorted(os.path.join(path, name) for name in os.listdir(path) if name.endswith('.html'))
+        else:
+            files.append(path)
+    pages = []
+    for name in files:
+        with open(name, 'rb') as file:
+            pages.append((name, file.read()))
+    return pages
+
+
+def report(title, count, unit, seconds):
+    print("%-8s %6d %s in %8.3fs, %10.1f %s/s" % (title, count, unit, seconds, count / seconds if seconds else 0, unit))
+
+
+
+####################
+##### Extract ######
+####################
+
+# The candidate extraction as it was done with BeautifulSoup before, used as
+# the baseline and to check that both produce the same candidates.
+def legacyCandidates(tucan, content):
+    soup = BeautifulSoup(content, 'lxml')
+    found = False
+    elems = []
+    for elem in soup.select("table:nth-of-type(1) td.tbdata > *"):
+        titles = elem.select("b")
+        if len(titles) > 0:
+            if found:
+                break
+            else:
+                for tag in titles:
+                    if tag.string.lower().startswith('literatur'):
+                        found = True
+        if found:
+            elems.append(elem)
+
+    flat = False
+    while not flat:
+        flat = True
+        new_elems = []
+        for tag in elems:
+            if hasattr(tag,'name') and tag.name:
+                new_elems += tag.contents
+                flat = False
+            elif str(tag):
+                new_elems.append(tag)
+        elems = new_elems
+
+    return [ text for text in (str(tag).strip() for tag in elems) if tucan.should_consider(text) ]
+
+
+def candidates(tucan, content):
+    page = lxml.html.fromstring(content)
+    return list(tucan.iterCandidates(tucan.iterLiteratureElements(page)))
+
+
+def benchmarkExtract(args):
+    pages = loadPages(args.pages)
+    if args.archive:
+        pages += export.HttpArchive(args.archive).bodies('PRGNAME=COURSEDETAILS')
+    tucan = export.Tucan()
+
+    results = {}
+    for title, extract in (('legacy', legacyCandidates), ('lxml', candidates)):
+        start = perf_counter()
+        for i in range(args.repeat):
+            results[title] = [ extract(tucan, content) for name, content in pages ]
+        report(title, len(pages) * args.repeat, 'pages', perf_counter() - start)
+
+    for (name, content), legacy, current in zip(pages, results['legacy'], results['lxml']):
+        if legacy != current:
+            print("Candidates differ for %s:\n  legacy: %s\n  lxml:   %s" % (name, legacy, current))
+
+
+
+##################
+##### Sanity #####
+##################
+
+# The sanity check as it was done before: one Levenshtein call per window of
+# the book string, stepping 4 characters at a time.
+def legacyWindowMatch(book_string, title):
+    len_title = len(title)
+    diff = len(book_string) - len_title
+    if diff >= 0:
+        for i in range(0, floor(diff / 4)):
+            index = 4 * i
+            test = book_string[index: index + len_title]
+            if Levenshtein.distance(test, title) / len_title < 0.7:
+                return True
+    return False
+
+
+def legacyBook(magic, book_string, volume):
+    book = magic.volumeBook(volume)
+    if book.title and legacyWindowMatch(book_string, book.title) \
+            and book.author and book.isbn and book.publisher and book.year:
+        return book
+    return None
+
+
+def volumeInfos(data, count):
+    items = (data.get('items', None) if data else None) or []
+    return [ item['volumeInfo'] for item in items[:count] if item.get('volumeInfo', None) ]
+
+
+# Before, only the first result was considered.
+def legacySanityCheck(magic, book_string, data):
+    volumes = volumeInfos(data, 1)
+    return legacyBook(magic, book_string, volumes[0]) if volumes else None
+
+
+# The old window loop over the same results the current check looks at, so
+# that both compare the same amount of work per candidate.
+def legacyTopSanityCheck(magic, book_string, data):
+    for volume in volumeInfos(data, export.SANITY_CHECK_TOP_RESULTS):
+        book = legacyBook(magic, book_string, volume)
+        if book:
+            return book
+    return None
+
+
+def benchmarkSanity(args):
+    responses = export.IsbnCache(args.cache).responses()
+    magic = export.IsbnMagic(None)
+
+    checks = (
+        ('legacy', lambda book_string, data: legacySanityCheck(magic, book_string, data)),
+        ('legacy-n', lambda book_string, data: legacyTopSanityCheck(magic, book_string, data)),
+        ('current', magic.selectBook),
+    )
+    results = {}
+    for title, check in checks:
+        seconds = min(timeit.repeat(
+            lambda: [ check(book_string, data) for book_string, data in responses ], number = 1, repeat = args.repeat
+        ))
+        accepted = sum(1 for book_string, data in responses if check(book_string, data))
+        results[title] = seconds
+        report(title, len(responses), 'candidates', seconds)
+        print("         %6d of %d candidates accepted, %.2f us per candidate" % (
+            accepted, len(responses), seconds * 1e6 / len(responses) if responses else 0))
+
+    for title in ('legacy', 'legacy-n'):
+        if results['current']:
+            print("speedup of current over %-8s %6.2fx" % (title + ':', results[title] / results['current']))
+
+
+
+##############
+### SCRIPT ###
+##############
+
+def main():
+    parser = ArgumentParser(description = "Offline benchmarks for tucan-export.")
+    commands = parser.add_subparsers(dest = 'command')
+    commands.required = True
+
+    extract = commands.add_parser('extract', help = "literature candidate extraction from saved module pages")
+    extract.add_argument('pages', nargs = '*', help = "saved module pages or directories containing them")
+    extract.add_argument('-a', '--archive', help = "HTTP archive recorded by tucan-export")
+    extract.add_argument('-n', '--repeat', type = int, default = 10,
+                         help = "number of passes over the pages (default: 10)")
+    extract.set_defaults(run = benchmarkExtract)
+
+    sanity = commands.add_parser('sanity', help = "ISBN sanity check over the responses recorded in an ISBN cache, "
+                                                  "compared with the old Levenshtein window loop")
+    sanity.add_argument('cache', help = "ISBN cache file written by tucan-export")
+    sanity.add_argument('-n', '--repeat', type = int, default = 10,
+                        help = "number of timed passes over the responses, the fastest counts (default: 10)")
+    sanity.set_defaults(run = benchmarkSanity)
+
+    args = parser.parse_args()
+    args.run(args)
+
+
+if __name__ == '__main__':
+    main()
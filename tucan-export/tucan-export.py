@@ -3,25 +3,36 @@
 # A cool tool accessing the not-so-cool TUCaN to retrieve the books that are
 # proposed by the lecturers.
 
+from argparse     import ArgumentParser
+from collections  import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib   import contextmanager
 from datetime     import datetime
-from json         import JSONDecoder
+from requests.adapters   import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils      import get_encoding_from_headers
 from robobrowser  import RoboBrowser
-from sys          import argv
-from threading    import Thread
-from time         import sleep
-from urllib.parse import urlencode
+from threading    import Condition, Lock
+from time         import perf_counter, sleep
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+from hashlib      import sha1
 from html         import unescape
-from math         import floor
-from Levenshtein import distance
+from rapidfuzz    import fuzz, utils
 import csv
-import http
+import io
+import json
+import lxml.html
 import logging
+import os
 import re
+import requests
+import sqlite3
+import threading
 
 # URLs.
 TUCAN_URL = 'https://www.tucan.tu-darmstadt.de'
 TUCAN_STARTPAGE_URL = "%s/scripts/mgrqcgi?APPNAME=CampusNet&PRGNAME=EXTERNALPAGES&ARGUMENTS=-N1,-N,-Awelcome" % TUCAN_URL
-GOOGLE_BOOKS_BASE_PATH = '/books/v1/volumes?'
+GOOGLE_BOOKS_URL = 'https://www.googleapis.com/books/v1/volumes'
 # CSS Selectors.
 TUCAN_CC_SELECTOR = '#pageTopNavi ul a'
 #TUCAN_DEPT_SELECTOR = '#auditRegistration_list li[title="Dept. 20 - Computer Science"] a'
@@ -30,10 +41,12 @@ TUCAN_DEPT_SELECTOR = '#auditRegistration_list li[title="FB20 - Informatik"] a'
 
 TUCAN_MODULE_CONTAINER_SELECTOR = '#auditRegistration_list li a'
 TUCAN_BREADCRUMBS_SELECTOR = '.pageElementTop > h2 > a'
-TUCAN_MODULE_COURSE_IDNAME_SELECTOR = '#pageContent form h1';
 TUCAN_MODULE_INFORMATION_SELECTOR = '#contentlayoutleft table:nth-of-type(1) tr:nth-of-type(2) p'
 TUCAN_MODULE_INFORMATION_TYPE_SELECTOR = 'b:nth-of-type(1)'
 TUCAN_MODULE_SELECTOR = '.eventTable td a'
+# XPath Expressions.
+TUCAN_MODULE_COURSE_IDNAME_XPATH = '//*[@id="pageContent"]//form//h1'
+TUCAN_MODULE_DETAILS_XPATH = '//table[1]//td[contains(concat(" ", normalize-space(@class), " "), " tbdata ")]/*'
 # RegEx Patterns.
 TUCAN_MODULE_COURSE_IDNAME_PATTERN = re.compile(r'^\s*(\w{2,2}-\w{2,2}-\w{4,4}-\w{2,2})\s*(.+?)\s*$')
 TUCAN_MODULE_COURSE_NAME_NORMALIZE_PATTERN = re.compile(r'^(?:\s|\\t)*(.*?)(?:\s|\\t)*$')
@@ -45,8 +58,14 @@ ISBN_RELIABILITY_BASE_VALUE = 50
 ISBN_RELIABILITY_MAX_VALUE = 100
 ISBN_RELIABILITY_BOOKSTRING_LENGTH = 50
 ISBN_RELIABILITY_BOOKSTRING_LENGTH_MULTIPLIER = 0.5
-SANITY_CHECK_STEPWIDTH = 4
-SANITY_CHECK_MAXRATIO = 0.6
+SANITY_CHECK_MIN_SCORE = 85
+SANITY_CHECK_MIN_WORD_SHARE = 0.5
+SANITY_CHECK_MIN_TITLE_SHARE = 0.25
+SANITY_CHECK_TOP_RESULTS = 5
+ISBN_REQUEST_TIMEOUT = 30
+ISBN_REQUEST_RETRIES = 4
+ISBN_REQUEST_BACKOFF = 1.0
+ISBN_RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
 
 
 
@@ -63,6 +82,7 @@ class Book:
         self.price = 0
         self.publisher = None
         self.year = None
+        self.book_string = None
 
 
     def __str__(self):
@@ -79,6 +99,25 @@ class Book:
 
     def __hash__(self):
         return hash(self.isbn) if self.isbn else 0
+
+
+    def toDict(self):
+        return {
+            'isbn': self.isbn,
+            'title': self.title,
+            'author': self.author,
+            'price': self.price,
+            'publisher': self.publisher,
+            'year': self.year,
+        }
+
+
+    @classmethod
+    def fromDict(cls, data):
+        book = cls()
+        for key, value in data.items():
+            setattr(book, key, value)
+        return book
 # end: Book
 
 
@@ -94,6 +133,8 @@ class Module:
         self.candidates = candidates
         # WARNING: This has to be changed every season!
         self.last_offered = semester
+        self.literature_hash = None
+        self.unchanged = False
 
 
     def __str__(self):
@@ -102,81 +143,541 @@ class Module:
 
     def __repr__(self):
         return str(self);
+
+
+    def toDict(self):
+        return {
+            'cid': self.cid,
+            'name': self.name,
+            'name_en': self.name_en,
+            'hash': self.literature_hash,
+            'candidates': self.candidates,
+            'books': self.books,
+        }
 # end: Module
 
 
+# The modules and books of a previous export, used to skip unchanged modules.
+class ExportState:
+    def __init__(self, modules = None, books = None):
+        self.modules = modules or {}
+        self.books = books or {}
+
+    @classmethod
+    def load(cls, path):
+        if not os.path.exists(path):
+            return cls()
+        with open(path, encoding = 'utf-8') as file:
+            data = json.load(file)
+        return cls(data.get('modules'), data.get('books'))
+
+    def save(self, path):
+        with open(path, 'w', encoding = 'utf-8') as file:
+            json.dump({'modules': self.modules, 'books': self.books}, file, indent = 2, ensure_ascii = False)
+
+    # Get the module from the previous export if its literature is unchanged.
+    def unchangedModule(self, url, literature_hash, category, semester):
+        entry = self.modules.get(url)
+        if not entry or not literature_hash or entry['hash'] != literature_hash:
+            return None
+        module = Module(entry['cid'], entry['name'], entry['name_en'], category, url, entry['candidates'], semester)
+        module.literature_hash = literature_hash
+        module.books = list(entry['books'])
+        module.unchanged = True
+        return module
+
+    def book(self, isbn):
+        return Book.fromDict(self.books[isbn])
+
+    def printDiff(self, other):
+        previous = { entry['cid']: (entry['name'], entry['hash']) for entry in self.modules.values() }
+        current = { entry['cid']: (entry['name'], entry['hash']) for entry in other.modules.values() }
+        added = [ cid for cid in current if cid not in previous ]
+        removed = [ cid for cid in previous if cid not in current ]
+        changed = [ cid for cid in current if cid in previous and previous[cid][1] != current[cid][1] ]
+        for title, cids, names in (
+            ("Added", added, current), ("Removed", removed, previous), ("Changed", changed, current)
+        ):
+            print("%s modules: %d" % (title, len(cids)))
+            for cid in cids:
+                print("  %s %s" % (cid, names[cid][0]))
+# end: ExportState
+
+
+# Journal of the modules that have been exported so far, so that an
+# interrupted export can be resumed where it stopped.
+class Checkpoint:
+    def __init__(self, path, resume = False):
+        self.path = path
+        self.module_urls = None
+        self.categories = []
+        self.done = set()
+        self.cids = set()
+        self.modules = OrderedDict()
+        self.books = {}
+        self.offsets = None
+        self.resumed = resume and self._load()
+        self.file = open(path, 'a' if self.resumed else 'w', encoding = 'utf-8')
+
+    # Read the journal up to the last complete entry and cut off the rest.
+    def _load(self):
+        if not os.path.exists(self.path):
+            return False
+        valid = 0
+        with open(self.path, 'rb') as file:
+            for line in file:
+                try:
+                    entry = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    break
+                if self.module_urls is None:
+                    self.module_urls = [ tuple(url) for url in entry['urls'] ]
+                    self.categories = entry['categories']
+                    self.offsets = entry.get('offsets')
+                else:
+                    self._apply(entry)
+                valid += len(line)
+        os.truncate(self.path, valid)
+        return self.module_urls is not None
+
+    def _apply(self, entry):
+        self.done.add(entry['url'])
+        if entry['module']:
+            self.cids.add(entry['module']['cid'])
+            self.modules[entry['url']] = entry['module']
+        self.books.update(entry['books'])
+        self.offsets = entry.get('offsets', self.offsets)
+
+    def _write(self, entry):
+        self.file.write(json.dumps(entry, ensure_ascii = False) + '\n')
+        self.file.flush()
+
+    # The offsets are the sizes of the CSV files once the rows of an entry
+    # have been written, see ExportWriter.
+    def start(self, module_urls, categories, offsets):
+        self.module_urls = module_urls
+        self.categories = categories
+        self.offsets = offsets
+        self._write({'urls': module_urls, 'categories': categories, 'offsets': offsets})
+
+    def record(self, url, offsets, module = None, books = {}):
+        entry = {
+            'url': url,
+            'module': module.toDict() if module else None,
+            'books': { isbn: book.toDict() for isbn, book in books.items() },
+            'offsets': offsets,
+        }
+        self._apply(entry)
+        self._write(entry)
+
+    def state(self):
+        return ExportState(self.modules, self.books)
+
+    def finish(self):
+        self.file.close()
+        os.remove(self.path)
+# end: Checkpoint
+
+
+# Appends the exported rows to the CSV files as soon as they are available.
+# When resuming, each file is first cut back to the size recorded in the
+# checkpoint, which drops the rows of a module that was not recorded and a
+# torn last line.
+class ExportWriter:
+    HEADERS = OrderedDict([
+        ('books', ['isbn_13', 'title', 'author', 'price', 'publisher', 'year']),
+        ('modules', ['books', 'category__name_de', 'module_id', 'name_de', 'name_en', 'last_offered']),
+        ('category', ['name_de']),
+    ])
+
+    def __init__(self, directory, offsets = None):
+        self.targets = OrderedDict(
+            (name, self._open(directory, name, header, offsets))
+            for name, header in self.HEADERS.items()
+        )
+        self.books = self.targets['books']
+        self.modules = self.targets['modules']
+        self.categories = self.targets['category']
+
+    def _open(self, directory, name, header, offsets):
+        path = os.path.join(directory, name + '.csv')
+        if offsets is not None and os.path.exists(path):
+            if name in offsets:
+                os.truncate(path, offsets[name])
+            mode = 'a'
+        else:
+            mode = 'w'
+        new = mode == 'w' or os.path.getsize(path) == 0
+        file = open(path, mode, newline = '')
+        writer = csv.writer(file, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_MINIMAL)
+        if new:
+            writer.writerow(header)
+            file.flush()
+        return (file, writer)
+
+    def _write(self, target, row):
+        file, writer = target
+        writer.writerow(row)
+        file.flush()
+
+    # The current size of each file, to be recorded in the checkpoint.
+    def offsets(self):
+        return { name: file.tell() for name, (file, writer) in self.targets.items() }
+
+    def writeBook(self, book):
+        self._write(self.books, [book.isbn, book.title, book.author, book.price, book.publisher, book.year])
+
+    def writeModule(self, module):
+        self._write(self.modules, [', '.join(module.books), module.category, module.cid, module.name, module.name_en, module.last_offered])
+
+    def writeCategories(self, categories):
+        for category in categories:
+            self._write(self.categories, [category,])
+
+    def close(self):
+        for file, writer in self.targets.values():
+            file.close()
+# end: ExportWriter
+
+
+# Archive of recorded HTTP exchanges, keyed by method and URL. The API key
+# is removed from the URLs, so archives can be shared.
+class HttpArchive:
+    def __init__(self, path):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS exchanges (request TEXT PRIMARY KEY, status INTEGER, reason TEXT, headers TEXT, body BLOB)'
+            )
+
+    @staticmethod
+    def key(request):
+        parts = urlsplit(request.url)
+        query = urlencode([ (name, value) for name, value in parse_qsl(parts.query, keep_blank_values = True) if name != 'key' ])
+        return '%s %s' % (request.method, urlunsplit(parts._replace(query = query)))
+
+    def get(self, request):
+        with self.lock:
+            return self.connection.execute(
+                'SELECT status, reason, headers, body FROM exchanges WHERE request = ?', (self.key(request),)
+            ).fetchone()
+
+    def put(self, request, response):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO exchanges (request, status, reason, headers, body) VALUES (?, ?, ?, ?, ?)',
+                (self.key(request), response.status_code, response.reason, json.dumps(dict(response.headers)), response.content)
+            )
+
+    # The recorded responses of all requests whose URL contains the pattern.
+    def bodies(self, pattern = ''):
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT request, body FROM exchanges WHERE instr(request, ?) > 0', (pattern,)
+            ).fetchall()
+        return rows
+# end: HttpArchive
+
+
+# Transport adapter for the HTTP traffic of the export. It counts all
+# requests and can record them to or replay them from an archive, with a
+# simulated latency per replayed request.
+class ArchiveAdapter(HTTPAdapter):
+    def __init__(self, archive = None, replay = False, latency = 0, **kwargs):
+        super().__init__(**kwargs)
+        self.archive = archive
+        self.replay = replay
+        self.latency = latency
+        self.lock = Lock()
+        self.requests = 0
+        self.bytes = 0
+
+    def send(self, request, **kwargs):
+        if self.replay:
+            response = self._replay(request)
+        else:
+            response = super().send(request, **kwargs)
+            if self.archive:
+                self.archive.put(request, response)
+        with self.lock:
+            self.requests += 1
+            self.bytes += len(response.content)
+        return response
+
+    def _replay(self, request):
+        if self.latency:
+            sleep(self.latency)
+        exchange = self.archive.get(request)
+        status, reason, headers, body = exchange if exchange else (404, 'Not Recorded', '{}', b'')
+
+        response = requests.Response()
+        response.status_code = status
+        response.reason = reason
+        response.headers = CaseInsensitiveDict(json.loads(headers))
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.raw = io.BytesIO(body)
+        response._content = body
+        response._content_consumed = True
+        response.url = request.url
+        response.request = request
+        return response
+
+    def sessions(self):
+        session = requests.Session()
+        session.mount('http://', self)
+        session.mount('https://', self)
+        return session
+# end: ArchiveAdapter
+
+
+# Persistent cache of Google Books responses, keyed by the normalized book string.
+class IsbnCache:
+    def __init__(self, path):
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, check_same_thread = False)
+        with self.connection:
+            self.connection.execute(
+                'CREATE TABLE IF NOT EXISTS volumes (query TEXT PRIMARY KEY, response TEXT, retrieved TEXT, book_string TEXT)'
+            )
+            columns = [ row[1] for row in self.connection.execute('PRAGMA table_info(volumes)') ]
+            if 'book_string' not in columns:
+                self.connection.execute('ALTER TABLE volumes ADD COLUMN book_string TEXT')
+
+    def get(self, query):
+        with self.lock:
+            row = self.connection.execute('SELECT response FROM volumes WHERE query = ?', (query,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def put(self, query, data, book_string = None):
+        with self.lock, self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO volumes (query, response, retrieved, book_string) VALUES (?, ?, ?, ?)',
+                (query, json.dumps(data), datetime.now().isoformat(), book_string)
+            )
+
+    # All recorded responses with the book string they were requested for.
+    def responses(self):
+        with self.lock:
+            rows = self.connection.execute('SELECT query, book_string, response FROM volumes').fetchall()
+        return [ (book_string or query, json.loads(response)) for query, book_string, response in rows ]
+# end: IsbnCache
+
+
 # Class to retrieve the ISBN from a book title by accessing the Google API "books".
 class IsbnMagic:
-    def __init__(self, api_key):
-        self.http_client = http.client.HTTPSConnection('www.googleapis.com')
+    def __init__(self, api_key, workers = 1, cache = None, sessions = requests.Session):
         self.api_key = api_key
-
-    def sanity_check(self, book_string, book):
-        print(book.title)
-
-        len_title = len(book.title)
-        len_searchstring = len(book_string)
-
-        valid = False
-        diff = len_searchstring - len_title
-        if diff >= 0:
-            for i in range(0, floor(diff / SANITY_CHECK_STEPWIDTH)):
-                index = SANITY_CHECK_STEPWIDTH * i
-                test = book_string[index: index + len_title]
-                ratio = distance(test, book.title) / len_title
-                if ratio < 0.7:
-                    valid = True
-                    break
-        if not valid:
-            return False
-
-        #if not book.title in book_string:
-        #    return False
-        if book.title and book.author and book.isbn and book.publisher and book.year:
-            return True
-        print("Missing?")
-        return False
+        self.workers = max(1, workers)
+        self.cache = cache
+        self.sessions = sessions
+        self.local = threading.local()
+
+    # Candidates are compared case-insensitively and regardless of whitespace.
+    @staticmethod
+    def normalize(book_string):
+        return ' '.join(book_string.split()).casefold()
+
+    # Each worker thread keeps its own HTTP session, so there are at most
+    # as many connections to Google as there are workers.
+    def _session(self):
+        session = getattr(self.local, 'session', None)
+        if not session:
+            session = self.local.session = self.sessions()
+        return session
+
+    # Pick the complete volume whose title matches the book string best. The
+    # volumes are checked in the order of the results, with cheap checks
+    # first. A title found verbatim in the book string scores 100. Any other
+    # title must not be longer than the book string and at least half of its
+    # words must occur in it. Only then is it scored (0 to 100) by a single
+    # partial_ratio call, which aligns it with the best matching part of the
+    # book string in C instead of one Levenshtein call per window, and gives
+    # up early if it cannot beat the best score so far. Scoring all titles
+    # with process.extract instead is slower, as few titles are left to score
+    # after the cheap checks. A title that makes up only a small part of the
+    # book string must also share an author's last name with it, as a short
+    # title is easily found in an unrelated book string. A perfect match ends
+    # the search.
+    def sanity_check(self, book_string, volumes):
+        text = utils.default_process(book_string)
+        words = None
+        best, best_score = None, 0
+        for volume in volumes:
+            title = utils.default_process(volume.get('title', None) or '')
+            if not title:
+                continue
+            if title in text:
+                score = 100
+            else:
+                if len(title) > len(text):
+                    continue
+                words = words or set(text.split())
+                title_words = title.split()
+                if len(words.intersection(title_words)) < SANITY_CHECK_MIN_WORD_SHARE * len(title_words):
+                    continue
+                score = fuzz.partial_ratio(text, title, score_cutoff = max(SANITY_CHECK_MIN_SCORE, best_score + 1))
+                if not score:
+                    continue
+            if not volume.get('authors', None) or not self.volumeIsbn(volume):
+                continue
+            if len(title) < SANITY_CHECK_MIN_TITLE_SHARE * len(text):
+                words = words or set(text.split())
+                if not any(names and names[-1] in words
+                           for names in (utils.default_process(author).split() for author in volume['authors'])):
+                    continue
+            best, best_score = volume, score
+            if score == 100:
+                break
+        return best, best_score
+
+    # Resolve the candidates of a stream of (item, candidates) jobs. Every
+    # distinct candidate is looked up once, and the items are yielded with
+    # their books in the order they came in, as soon as they are resolved.
+    def iterResolved(self, jobs):
+        futures = {}
+        pending = deque()
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            def submit(book_string):
+                key = self.normalize(book_string)
+                if key not in futures:
+                    futures[key] = executor.submit(self.retrieveAndSetData, book_string)
+                return futures[key]
+
+            for item, book_strings in jobs:
+                pending.append((item, [ submit(book_string) for book_string in book_strings ]))
+                while pending and all(future.done() for future in pending[0][1]):
+                    item, results = pending.popleft()
+                    yield item, [ future.result() for future in results ]
+            while pending:
+                item, results = pending.popleft()
+                yield item, [ future.result() for future in results ]
+
+    def retrieveVolumes(self, book_string):
+        query = self.normalize(book_string)
+        data = self.cache.get(query) if self.cache else None
+        if data is None:
+            data = self._request(' '.join(book_string.split()))
+            if data is not None and self.cache:
+                self.cache.put(query, data, book_string)
+        return data
+
+    # A failed lookup is logged and yields no data. It never raises, as that
+    # would abort the resolution of all other candidates.
+    def _request(self, book_string):
+        params = {
+            'q': book_string,
+            'key': self.api_key,
+        }
+        delay = ISBN_REQUEST_BACKOFF
+        for attempt in range(ISBN_REQUEST_RETRIES + 1):
+            try:
+                response = self._session().get(GOOGLE_BOOKS_URL, params = params, timeout = ISBN_REQUEST_TIMEOUT)
+                if response.ok:
+                    return response.json()
+                if response.status_code not in ISBN_RETRY_STATUS_CODES:
+                    logging.warning("Google Books lookup for '%s' failed with status %d." % (book_string, response.status_code))
+                    return None
+            except (requests.ConnectionError, requests.Timeout):
+                pass
+            except (requests.RequestException, ValueError):
+                logging.warning("Google Books lookup for '%s' failed." % book_string, exc_info = True)
+                return None
+            if attempt < ISBN_REQUEST_RETRIES:
+                sleep(delay)
+                delay *= 2
+        logging.warning("Giving up on Google Books lookup for '%s'." % book_string)
+        return None
 
     def retrieveAndSetData(self, book_string):
         print("\n" + book_string)
-        isbn_reliability = 0
+        return self.selectBook(book_string, self.retrieveVolumes(book_string))
+
+    def selectBook(self, book_string, data):
+        items = data.get('items', None) if data else None
+        volumes = ( item['volumeInfo'] for item in (items or [])[:SANITY_CHECK_TOP_RESULTS]
+                    if item.get('volumeInfo', None) )
+
+        volume, score = self.sanity_check(book_string, volumes)
+        if not volume:
+            return None
+
+        book = self.volumeBook(volume)
+        book.isbn_reliability = 0
         if len(book_string) > ISBN_RELIABILITY_BOOKSTRING_LENGTH:
-            isbn_reliability = min(int(ISBN_RELIABILITY_BASE_VALUE + len(book_string) * ISBN_RELIABILITY_BOOKSTRING_LENGTH_MULTIPLIER), ISBN_RELIABILITY_MAX_VALUE)
-        path = GOOGLE_BOOKS_BASE_PATH + urlencode({
-            'q': book_string,
-            'key': self.api_key,
-        })
-        self.http_client.request('GET', path)
-        response = self.http_client.getresponse()
-        content = response.read().decode('UTF-8')
-        data = JSONDecoder().decode(content)
-        data = data.get('items', None) if data else None
-        data = data[0] if data else None
-        data = data.get('volumeInfo', None) if data else None
-
-        if data:
-            book = Book()
-            for id_opt in data.get('industryIdentifiers', None):
-                id_type = id_opt.get('type', None)
-                if id_type == 'ISBN_13':
-                    book.isbn = id_opt.get('identifier', None)
-                    break
-            book.title = data.get('title', None)
-            book.author = ', '.join(data.get('authors', []))
-            book.publisher = data.get('publisher', 'Unknown')
-            book.year = data.get('publishedDate', '0').split('-')[0]
-            book.isbn_reliability = isbn_reliability
-            if self.sanity_check(book_string, book):
-                return book
+            book.isbn_reliability = min(int(ISBN_RELIABILITY_BASE_VALUE + len(book_string) * ISBN_RELIABILITY_BOOKSTRING_LENGTH_MULTIPLIER), ISBN_RELIABILITY_MAX_VALUE)
+        book.book_string = book_string
+        book.match_ratio = score / 100
+        return book
+
+    def volumeIsbn(self, data):
+        for id_opt in data.get('industryIdentifiers', []):
+            id_type = id_opt.get('type', None)
+            if id_type == 'ISBN_13':
+                return id_opt.get('identifier', None)
         return None
+
+    def volumeBook(self, data):
+        book = Book()
+        book.isbn = self.volumeIsbn(data)
+        book.title = data.get('title', None)
+        book.author = ', '.join(data.get('authors', []))
+        book.publisher = data.get('publisher', 'Unknown')
+        book.year = data.get('publishedDate', '0').split('-')[0]
+        return book
 # end: IsbnMagic
 
 
+# Pool of reusable browser sessions, shared by the crawler threads.
+class BrowserPool:
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.created = 0
+        self.browsers = []
+        self.condition = Condition()
+
+    # A slot is reserved before the browser is created and given back if the
+    # creation fails, so waiting threads can create the browser instead.
+    def acquire(self):
+        with self.condition:
+            while not self.browsers and self.created >= self.size:
+                self.condition.wait()
+            if self.browsers:
+                return self.browsers.pop()
+            self.created += 1
+        try:
+            return self.factory()
+        except BaseException:
+            with self.condition:
+                self.created -= 1
+                self.condition.notify()
+            raise
+
+    def release(self, browser):
+        with self.condition:
+            self.browsers.append(browser)
+            self.condition.notify()
+
+    @contextmanager
+    def browser(self):
+        browser = self.acquire()
+        try:
+            yield browser
+        finally:
+            self.release(browser)
+# end: BrowserPool
+
+
 # Class to access TUCaN and return the results as modules (see Module).
 class Tucan:
 
-    def __init__(self):
+    def __init__(self, workers = 1, state = None, sessions = requests.Session):
         self.categories = []
+        self.workers = max(1, workers)
+        self.state = state
+        self.sessions = sessions
+        self.pool = BrowserPool(self._createBrowser, self.workers)
 
     def should_consider(self, book_string):
         if len(book_string) < 15:
@@ -186,143 +687,107 @@ class Tucan:
         return True
 
     def retrieveModule(self, module_url, category, semester):
-        browser = self._createBrowser()
+        with self.pool.browser() as browser:
+            return self._retrieveModule(browser, module_url, category, semester)
+
+
+    def _retrieveModule(self, browser, module_url, category, semester):
         browser.open(TUCAN_URL + module_url)
+        page = lxml.html.fromstring(browser.response.content)
 
-        cidname_element = browser.select(TUCAN_MODULE_COURSE_IDNAME_SELECTOR)[0];
-        cidname_match = TUCAN_MODULE_COURSE_IDNAME_PATTERN.match(cidname_element.text);
-        cid = cidname_match.group(1);
-        name = cidname_match.group(2);
+        cid, name = self.parseCourseIdName(page)
+        literature = list(self.iterLiteratureElements(page))
 
-        elements = browser.select("table:nth-of-type(1) td.tbdata > *")
-        found = False
-        elems = []
-        for elem in elements:
-            titles = elem.select("b")
-            if len(titles) > 0:
-                if found:
-                    break
-                else:
-                    for tag in titles:
-                        if tag.string.lower().startswith('literatur'):
-                            found = True
-            if found:
-                elems.append(elem)
-
-        # Flatten Elems:
-        flat = False
-        while not flat:
-            flat = True
-            new_elems = []
-            for tag in elems:
-                if hasattr(tag,'name') and tag.name:
-                    new_elems += tag.contents
-                    flat = False
-                elif str(tag):
-                    new_elems.append(tag)
-            elems = new_elems
-
-        # Check the remaining
-        texts = []
-        for tag in elems:
-            tag = str(tag).strip()
-            texts.append(tag)
-
-        #information = browser.select(TUCAN_MODULE_INFORMATION_SELECTOR);
-        #literature = None
-        #for info in information:
-        #    text = info.select(TUCAN_MODULE_INFORMATION_TYPE_SELECTOR)[0].text.lower()
-        #    if text.startswith('literatur'):
-        #        literature = info
-        #        break
+        literature_hash = sha1(' '.join([cid, name] + [
+            lxml.html.tostring(elem, encoding = 'unicode') for elem in literature
+        ]).encode('utf-8')).hexdigest()
+        if self.state:
+            module = self.state.unchangedModule(module_url, literature_hash, category, semester)
+            if module:
+                print("%s is unchanged." % module.name)
+                return module
+
+        candidates = list(self.iterCandidates(literature))
 
         module_url_en = module_url.replace('-N000000000000001', '-N000000000000002')
         browser.open(TUCAN_URL + module_url_en)
-
-        cidname_element_en = browser.select(TUCAN_MODULE_COURSE_IDNAME_SELECTOR)[0];
-        cidname_match_en = TUCAN_MODULE_COURSE_IDNAME_PATTERN.match(cidname_element_en.text);
-        cid_en = cidname_match_en.group(1);
-        name_en = cidname_match_en.group(2);
+        cid_en, name_en = self.parseCourseIdName(lxml.html.fromstring(browser.response.content))
 
         print(name)
         print(name_en)
-
-        candidates = []
-
-        for text in texts:
-            print(text)
-            if self.should_consider(text):
-                candidates.append(text)
-
-        #if literature:
-        #    # Only process if there is literature, of course.
-
-        #   literature_content = TUCAN_MODULE_LITERATURE_CONTENT_PATTERN.sub(r'\2', str(literature).replace('\n', '').replace('\r', ''))
-        #   next_book = None
-        #   pause = False
-        #   for char in literature_content:
-        #       book = None
-        #       if char == '<':
-        #           if next_book:
-        #               book_string = unescape(TUCAN_MODULE_COURSE_NAME_NORMALIZE_PATTERN.sub(r'\1', next_book))
-        #               if self.should_consider(book_string):
-        #                   candidates.append(book_string)
-        #               next_book = None
-        #           pause = True
-        #       elif char == '>':
-        #           pause = False
-        #       elif not pause:
-        #           next_book = next_book + char if next_book else char
-        #   if next_book:
-        #       book_string = unescape(TUCAN_MODULE_COURSE_NAME_NORMALIZE_PATTERN.sub(r'\1', next_book))
-        #       if self.should_consider(book_string):
-        #           candidates.append(book_string)
+        for candidate in candidates:
+            print(candidate)
 
         print("")
-        return Module(cid, name, name_en, category, module_url, candidates, semester)
+        module = Module(cid, name, name_en, category, module_url, candidates, semester)
+        module.literature_hash = literature_hash
+        return module
 
 
-    def retrieveModules(self, semester):
-        print('Retrieving modules...')
+    def parseCourseIdName(self, page):
+        cidname_element = page.xpath(TUCAN_MODULE_COURSE_IDNAME_XPATH)[0]
+        cidname_match = TUCAN_MODULE_COURSE_IDNAME_PATTERN.match(cidname_element.text_content())
+        return cidname_match.group(1), cidname_match.group(2)
 
-        module_urls = tucan.retrieveModuleUrls()
 
-        module_cids = []
-        modules = {}
-        i = 1
-        for url, category in module_urls:
-            try:
-                print("Loading module %d/%d..." % (i, len(module_urls)))
-                print(category)
+    # Yield the elements of the module details that make up the literature
+    # section: the one with a "Literatur..." heading up to the next heading.
+    def iterLiteratureElements(self, page):
+        found = False
+        for elem in page.xpath(TUCAN_MODULE_DETAILS_XPATH):
+            titles = [ title.text_content() for title in elem.iterdescendants('b') ]
+            if titles:
+                if found:
+                    return
+                found = any(title.lower().startswith('literatur') for title in titles)
+            if found:
+                yield elem
 
-                module = tucan.retrieveModule(url, category, semester)
-                if module.cid in modules:
-                    print("Skipping module %d/%d as it is a duplicate!" % (i, len(module_urls)))
-                else:
-                    modules[module.cid] = module
 
-                print("Loaded module %d." % i)
+    # Yield the text pieces of the literature section that look like a book.
+    def iterCandidates(self, literature):
+        for elem in literature:
+            for text in elem.itertext():
+                text = text.strip()
+                if self.should_consider(text):
+                    yield text
 
-                i += 1
-                #if i > 5:
-                #    break
-            except:
-                logging.warning("Failed to process module at <%s>! Error:" % url, exc_info = True)
 
-        print("Retrieved %d modules." % len(modules))
+    # The pool may finish modules out of order, but map() yields them in the
+    # order of the URLs, so deduplicating the results stays stable.
+    def iterModules(self, module_urls, semester):
+        count = len(module_urls)
+        jobs = [ (i, count, url, category, semester) for i, (url, category) in enumerate(module_urls, 1) ]
 
-        return modules.values()
+        with ThreadPoolExecutor(max_workers = self.workers) as executor:
+            for module in executor.map(lambda job: self._loadModule(*job), jobs):
+                if module:
+                    yield module
+
+
+    def _loadModule(self, i, count, url, category, semester):
+        try:
+            print("Loading module %d/%d..." % (i, count))
+            print(category)
+
+            module = self.retrieveModule(url, category, semester)
+
+            print("Loaded module %d." % i)
+            return module
+        except Exception:
+            logging.warning("Failed to process module at <%s>! Error:" % url, exc_info = True)
+            return None
 
 
     def retrieveModuleUrls(self):
         print('Retrieving module URLs...')
 
-        browser = self._createBrowser();
-
-        browser.follow_link(browser.select(TUCAN_CC_SELECTOR)[1])
-        browser.follow_link(browser.select(TUCAN_DEPT_SELECTOR)[0])
+        with self.pool.browser() as browser:
+            browser.open(TUCAN_STARTPAGE_URL)
+            browser.follow_link(browser.select(TUCAN_CC_SELECTOR)[1])
+            browser.follow_link(browser.select(TUCAN_DEPT_SELECTOR)[0])
 
-        module_urls = self._retrieveModuleUrls(browser)
+            module_urls = self._retrieveModuleUrls(browser)
 
         print("Retrieved %d module URLs." % len(module_urls))
 
@@ -352,7 +817,7 @@ class Tucan:
 
     def _createBrowser(self):
         try:
-            browser = RoboBrowser(parser = 'lxml')
+            browser = RoboBrowser(session = self.sessions(), parser = 'lxml', history = 1)
             browser.open(TUCAN_STARTPAGE_URL)
             return browser
         except Exception:
@@ -364,69 +829,107 @@ class Tucan:
 ### SCRIPT ###
 ##############
 
-if len(argv) < 3:
-    print("Usage: python ./tucan-export.py <semester> <api-key>")
-    exit(1)
-
-semester = argv[1]
-api_key = argv[2]
-
-book_export_file = semester + "/books.csv"
-module_export_file = semester + "/modules.csv"
-category_export_file = semester + "/category.csv"
-
-tucan = Tucan()
-modules = tucan.retrieveModules(semester)
-isbnMagic = IsbnMagic(api_key)
-books = {}
-i = 1
-imax = len(modules)
-count = 1
-for module in modules:
-    j = 1
-    jmax = len(module.candidates)
-    for candidate in module.candidates:
-        print("Loading book %d/%d of module %d/%d..." % (j, jmax, i, imax))
-
-        book = isbnMagic.retrieveAndSetData(candidate)
-        if book:
-            module.books.append(book.isbn)
-            if book.isbn not in books:
-                books[book.isbn] = book
-                print("ADDED\n")
-            else:
-                print("DUPLICATE\n")
+def main():
+    parser = ArgumentParser(description = "Export the literature of the TUCaN modules.")
+    parser.add_argument('semester')
+    parser.add_argument('api_key', metavar = 'api-key')
+    parser.add_argument('-w', '--workers', type = int, default = 1,
+                        help = "number of module pages to load concurrently (default: 1)")
+    parser.add_argument('-l', '--lookups', type = int, default = 4,
+                        help = "number of concurrent Google Books connections (default: 4)")
+    parser.add_argument('-c', '--cache', default = 'isbn-cache.sqlite',
+                        help = "file to cache Google Books responses in (default: isbn-cache.sqlite)")
+    parser.add_argument('--no-cache', dest = 'cache', action = 'store_const', const = None,
+                        help = "always query Google Books")
+    parser.add_argument('-i', '--incremental', metavar = 'STATE',
+                        help = "reuse the modules of the previous export stored in STATE and update it")
+    parser.add_argument('-r', '--resume', action = 'store_true',
+                        help = "continue an interrupted export from its checkpoint")
+    archive = parser.add_mutually_exclusive_group()
+    archive.add_argument('--record', metavar = 'ARCHIVE',
+                         help = "record all HTTP exchanges to ARCHIVE")
+    archive.add_argument('--replay', metavar = 'ARCHIVE',
+                         help = "answer all HTTP requests from ARCHIVE instead of the network")
+    parser.add_argument('--latency', type = float, default = 0,
+                        help = "seconds to wait before each replayed response (default: 0)")
+    args = parser.parse_args()
+
+    semester = args.semester
+    api_key = args.api_key
+
+    start = perf_counter()
+    adapter = ArchiveAdapter(
+        HttpArchive(args.record or args.replay) if args.record or args.replay else None,
+        replay = bool(args.replay),
+        latency = args.latency,
+        pool_maxsize = args.workers + args.lookups,
+    )
+
+    os.makedirs(semester, exist_ok = True)
+    checkpoint = Checkpoint(os.path.join(semester, 'checkpoint.jsonl'), args.resume)
+    state = ExportState.load(args.incremental) if args.incremental else None
+
+    tucan = Tucan(args.workers, state, adapter.sessions)
+    isbnMagic = IsbnMagic(api_key, args.lookups, IsbnCache(args.cache) if args.cache else None, adapter.sessions)
+
+    if checkpoint.resumed:
+        print("Resuming after %d of %d modules." % (len(checkpoint.done), len(checkpoint.module_urls)))
+        tucan.categories = checkpoint.categories
+        writer = ExportWriter(semester, checkpoint.offsets or {})
+    else:
+        module_urls = tucan.retrieveModuleUrls()
+        writer = ExportWriter(semester)
+        writer.writeCategories(tucan.categories)
+        checkpoint.start(module_urls, tucan.categories, writer.offsets())
+
+    module_urls = [ (url, category) for url, category in checkpoint.module_urls if url not in checkpoint.done ]
+    modules = tucan.iterModules(module_urls, semester)
+    jobs = ( (module, [] if module.unchanged else module.candidates) for module in modules )
+
+    for module, results in isbnMagic.iterResolved(jobs):
+        if module.cid in checkpoint.cids:
+            print("Skipping module %s as it is a duplicate!" % module.cid)
+            checkpoint.record(module.url, writer.offsets())
+            continue
+
+        books = {}
+        if module.unchanged:
+            for isbn in module.books:
+                if isbn not in checkpoint.books:
+                    books[isbn] = state.book(isbn)
         else:
-            print("IGNORED\n")
-
-        j += 1
-        count += 1
-
-    i += 1
-print("Retrieved %d books." % count)
-
-with open(book_export_file, 'w') as file:
-    writer = csv.writer(file, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_MINIMAL)
-    writer.writerow(['isbn_13', 'title', 'author', 'price', 'publisher', 'year'])
-    print('Writing books file...', end='')
-    count = 0
-    for book in books.values():
-        count += 1
-        writer.writerow([book.isbn, book.title, book.author, book.price, book.publisher, book.year])
-    print(" Done! Wrote {} books.".format(count))
-
-with open(module_export_file, 'w') as file:
-    writer = csv.writer(file, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_MINIMAL)
-    writer.writerow(['books', 'category__name_de', 'module_id', 'name_de', 'name_en', 'last_offered'])
-    print('Writing modules file...')
-    for module in modules:
-        writer.writerow([', '.join(module.books), module.category, module.cid, module.name, module.name_en, module.last_offered])
-    print(" Done!")
-
-with open(category_export_file, 'w') as file:
-    writer = csv.writer(file, delimiter = ',', quotechar = '"', quoting = csv.QUOTE_MINIMAL)
-    writer.writerow(['name_de'])
-    print('Writing categories file...')
-    for category in tucan.categories:
-        writer.writerow([category,])
-    print(" Done!")
+            for candidate, book in zip(module.candidates, results):
+                print("Book of module %s: %s" % (module.cid, candidate))
+                if book:
+                    module.books.append(book.isbn)
+                    if book.isbn not in checkpoint.books and book.isbn not in books:
+                        books[book.isbn] = book
+                        print("ADDED\n")
+                    else:
+                        print("DUPLICATE\n")
+                else:
+                    print("IGNORED\n")
+
+        for book in books.values():
+            writer.writeBook(book)
+        writer.writeModule(module)
+        checkpoint.record(module.url, writer.offsets(), module, books)
+
+    writer.close()
+    print("Exported %d modules with %d books." % (len(checkpoint.modules), len(checkpoint.books)))
+
+    elapsed = perf_counter() - start
+    print("%d HTTP requests (%d kB) in %.1fs: %.1f pages/s, %.2f modules/s." % (
+        adapter.requests, adapter.bytes // 1024, elapsed,
+        adapter.requests / elapsed, len(checkpoint.modules) / elapsed,
+    ))
+
+    if state:
+        exported = checkpoint.state()
+        state.printDiff(exported)
+        exported.save(args.incremental)
+    checkpoint.finish()
+
+
+if __name__ == '__main__':
+    main()